@@ -3,77 +3,846 @@ Module performs searching of the best path on 2D grid between
 two given points by using famous A* method.
 Code is based on example from
 https://www.redblobgames.com/pathfinding/a-star/implementation.html
+
+The search works on flat integer node ids instead of (i, j) tuples.
+The cost grid is surrounded by a one cell wide border of walls,
+so neighbors of a node are found by adding fixed offsets to its id
+and no bounds checking is needed. Costs, parents and the closed set
+are kept in preallocated numpy arrays that are accessed through
+memoryviews, which return plain python ints.
 '''
 
-import heapq
-
-from qgis.core import QgsTask, QgsMessageLog
-
-class PriorityQueue:
-    def __init__(self):
-        self.elements = []
-    
-    def empty(self):
-        return len(self.elements) == 0
-    
-    def put(self, item, priority):
-        heapq.heappush(self.elements, (priority, item))
-    
-    def get(self):
-        return heapq.heappop(self.elements)[1]
-
-def heuristic(a, b):
-    (x1, y1) = a
-    (x2, y2) = b
-    return abs(x1 - x2) + abs(y1 - y2)
-
-def get_neighbors(size_i, size_j, ij):
-    """ returns possible neighbors of a numpy cell """
-    i,j = ij
-    neighbors = set()
-    if i>0:
-        neighbors.add((i-1, j))
-    if j>0:
-        neighbors.add((i, j-1))
-    if i<size_i-1:
-        neighbors.add((i+1, j))
-    if j<size_j-1:
-        neighbors.add((i, j+1))
-    return neighbors
-
-def get_cost(array, current, next):
-    return array[next]
-
-def FindPathFunction(graph, start, goal):
-
-    frontier = PriorityQueue()
-    frontier.put(start, 0)
-    came_from = {}
-    cost_so_far = {}
-    came_from[start] = None
-    cost_so_far[start] = 0
-
-    size_i, size_j = graph.shape
-
-    while not frontier.empty():
-        current = frontier.get()
-
-        if current == goal:
+from collections import OrderedDict
+from heapq import heappush, heappop
+from threading import Lock
+
+import numpy as np
+
+from qgis.core import QgsTask
+
+from .utils import read_tiled
+
+# cost of the cells that can't be entered
+WALL = -1
+
+# 4-connected neighborhood of a cell
+NEIGHBOR_OFFSETS = ((-1, 0), (0, -1), (1, 0), (0, 1))
+
+# how many nodes are expanded between checks of cancellation
+CANCEL_CHECK_INTERVAL = 1024
+
+# how many times the margin of the search window grows
+# when the search reached its sides
+WINDOW_GROWTH = 4
+
+# the window is not grown beyond this many cells, the search inside
+# the largest window is run to the end and its best path is taken,
+# so the search over large mosaics never reads the whole raster
+MAX_WINDOW_AREA = 4096 * 4096
+
+# size of the square tile of CoarseGrid in the coarse cells
+COARSE_TILE_SIZE = 64
+
+# how many bytes of coarse tiles a single CoarseGrid may keep
+COARSE_GRID_BUDGET = 32 * 1024 ** 2
+
+# how many blocks of the coarse path are refined on the full grid at once,
+# the full resolution costs are read only around these blocks
+COARSE_SEGMENT_BLOCKS = 16
+
+
+class SearchGrid:
+    '''
+    Flat representation of 2D cost grid that is used by the search.
+    Node id of the cell (i, j) is (i + 1) * width + (j + 1),
+    where width is the width of the grid with the border.
+    '''
+
+    def __init__(self, graph):
+        size_i, size_j = graph.shape
+        self.size_i = size_i
+        self.size_j = size_j
+        self.width = size_j + 2
+        self.size = (size_i + 2) * self.width
+
+        cost = np.full((size_i + 2, size_j + 2), WALL, dtype=np.int64)
+        cost[1:-1, 1:-1] = graph[:, :]
+        self.cost = cost.ravel()
+        self.offsets = tuple(di * self.width + dj
+                             for di, dj in NEIGHBOR_OFFSETS)
+
+    def node(self, ij):
+        i, j = ij
+        return (i + 1) * self.width + j + 1
+
+    def ij(self, node):
+        i, j = divmod(node, self.width)
+        return i - 1, j - 1
+
+
+def get_crossing_costs(min_costs, goal):
+    '''
+    Returns for every row (or column) the smallest cost of reaching
+    the row of the goal from it: each row on the way, including the
+    row of the goal, is entered at least once and costs at least
+    its smallest cost given by min_costs.
+    '''
+
+    sums = np.concatenate(([0], np.cumsum(min_costs)))
+    index = np.arange(len(min_costs))
+    return np.where(index < goal,
+                    sums[goal + 1] - sums[index + 1],
+                    sums[index] - sums[goal])
+
+
+def manhattan_estimates(grid, goal_node, stop=None):
+    '''
+    Manhattan distance from every node of the SearchGrid to goal_node,
+    that is one per pixel. Overestimates the paths over cheap cells.
+    '''
+
+    goal_i, goal_j = divmod(goal_node, grid.width)
+    rows = np.abs(np.arange(grid.size // grid.width) - goal_i)
+    columns = np.abs(np.arange(grid.width) - goal_j)
+    return np.add.outer(rows, columns)
+
+
+def get_leaving_costs(row_costs, column_costs, stop):
+    '''
+    Returns 2D array of the lower bounds of the cost of reaching
+    the cells marked by the flat stop array from every node: the
+    smallest cost of crossing the rows to a row of marked cells or the
+    columns to a column of them. The sides of the windows are such rows
+    and columns, see get_window_sides. If other cells are marked,
+    the bound is zero.
+    '''
+
+    marked = stop.reshape(len(row_costs), len(column_costs))
+    inner = marked[1:-1, 1:-1]
+    side_rows = np.flatnonzero(inner.all(axis=1)) + 1
+    side_columns = np.flatnonzero(inner.all(axis=0)) + 1
+
+    covered = np.zeros_like(marked)
+    covered[side_rows, :] = True
+    covered[:, side_columns] = True
+    if (marked & ~covered).any():
+        return np.zeros(marked.shape, dtype=np.int64)
+
+    # the crossing costs never decrease with the distance,
+    # so the nearest marked row or column is the cheapest
+    rows = np.full(len(row_costs), np.iinfo(np.int64).max)
+    for side in side_rows:
+        rows = np.minimum(rows, get_crossing_costs(row_costs, side))
+    columns = np.full(len(column_costs), np.iinfo(np.int64).max)
+    for side in side_columns:
+        columns = np.minimum(columns,
+                             get_crossing_costs(column_costs, side))
+    return np.minimum.outer(rows, columns)
+
+
+def admissible_estimates(grid, goal_node, stop=None):
+    '''
+    Lower bound of the cost from every node of the SearchGrid
+    to goal_node: the larger of the costs of crossing the rows and
+    the columns between them, see get_crossing_costs. The costs
+    outside the grid are unknown, so if the search may leave the grid
+    through the cells marked by stop, the bound is not larger than
+    the cost of reaching them, see get_leaving_costs. It never
+    overestimates and it is consistent, so the path found is optimal.
+    It is at least the smallest cost of the grid times the Manhattan
+    distance, but the rows and columns that contain a pixel of the
+    target color cost nothing, so for color_diff on the rasters where
+    such pixels are everywhere it is close to zero and the search is
+    close to Dijkstra.
+    '''
+
+    goal_i, goal_j = divmod(goal_node, grid.width)
+    cost = grid.cost.reshape(-1, grid.width)
+    walls = cost == WALL
+    # the rows of the border consist of walls only and are never entered
+    cost = np.where(walls, 0, cost)
+    row_costs = np.where(walls.all(axis=1), 0,
+                         np.where(walls, cost.max(), cost).min(axis=1))
+    column_costs = np.where(walls.all(axis=0), 0,
+                            np.where(walls, cost.max(), cost).min(axis=0))
+    rows = get_crossing_costs(row_costs, goal_i)
+    columns = get_crossing_costs(column_costs, goal_j)
+    estimates = np.maximum.outer(rows, columns)
+    if stop is not None:
+        estimates = np.minimum(estimates, get_leaving_costs(
+            row_costs, column_costs, stop))
+    return estimates
+
+
+# possible heuristics: functions that return estimates of the cost
+# from every node of the SearchGrid to the goal node as 2D array,
+# given the optional stop array of the search
+HEURISTICS = {
+    'manhattan': manhattan_estimates,
+    'admissible': admissible_estimates,
+    }
+
+
+def get_estimates(grid, goal_node, heuristic='manhattan', epsilon=0,
+                  stop=None):
+    '''
+    Returns flat int array of the estimates of the remaining cost
+    indexed by node id. heuristic is the key of HEURISTICS, stop is
+    the stop array of the search. With epsilon > 0 the estimates are
+    inflated (1 + epsilon) times, that is weighted A*: the search
+    expands less nodes and with the admissible heuristic finds
+    the path that costs at most (1 + epsilon) times the optimal one.
+    '''
+
+    estimates = HEURISTICS[heuristic](grid, goal_node, stop)
+    if epsilon:
+        estimates = estimates * (1 + epsilon)
+    return estimates.astype(np.int64).ravel()
+
+
+def search(grid, start_node, goal_node, is_canceled=None, stop=None,
+           heuristic='manhattan', epsilon=0):
+    '''
+    Runs A* on the SearchGrid from start_node to goal_node.
+    heuristic and epsilon choose the heuristic, see get_estimates.
+    Returns numpy arrays (came_from, cost_so_far, closed) indexed by
+    node id, or None if the search was canceled by is_canceled callable.
+    closed marks every node that was expanded at least once.
+    stop is an optional boolean array indexed by node id, the search
+    is interrupted as soon as any of the marked nodes is expanded,
+    in that case closed[goal_node] is False.
+    '''
+
+    size = grid.size
+    offsets = grid.offsets
+    cost = memoryview(grid.cost)
+
+    cost_so_far = np.full(size, -1, dtype=np.int64)
+    came_from = np.full(size, -1, dtype=np.int64)
+    closed = np.zeros(size, dtype=np.bool_)
+    cost_so_far_view = memoryview(cost_so_far)
+    came_from_view = memoryview(came_from)
+    closed_view = memoryview(closed)
+    stop_view = None if stop is None else memoryview(stop)
+
+    estimate = memoryview(get_estimates(grid, goal_node, heuristic, epsilon,
+                                        stop))
+
+    # items of the frontier are single ints: priority * size + node
+    frontier = [estimate[start_node] * size + start_node]
+    cost_so_far_view[start_node] = 0
+    expanded = 0
+
+    while frontier:
+        priority, current = divmod(heappop(frontier), size)
+        current_cost = cost_so_far_view[current]
+
+        if priority != current_cost + estimate[current]:
+            # stale duplicate of the node that was reached cheaper later
+            continue
+        closed_view[current] = True
+
+        if current == goal_node:
+            break
+
+        if stop_view is not None and stop_view[current]:
+            break
+
+        expanded += 1
+        if is_canceled is not None \
+                and expanded % CANCEL_CHECK_INTERVAL == 0 \
+                and is_canceled():
+            return None
+
+        for offset in offsets:
+            next = current + offset
+            step_cost = cost[next]
+            if step_cost == WALL:
+                continue
+
+            new_cost = current_cost + step_cost
+            old_cost = cost_so_far_view[next]
+            if old_cost < 0 or new_cost < old_cost:
+                # the node is expanded again if it was reached cheaper
+                cost_so_far_view[next] = new_cost
+                came_from_view[next] = current
+                priority = new_cost + estimate[next]
+                heappush(frontier, priority * size + next)
+
+    return came_from, cost_so_far, closed
+
+
+def search_bidirectional(grid, start_node, goal_node, is_canceled=None,
+                         stop=None):
+    '''
+    Runs Dijkstra on the SearchGrid from start_node and from goal_node
+    at once, always expanding the direction with the cheaper frontier.
+    The search ends when the sum of both frontier costs reaches
+    the cost of the best path through a node reached from both sides,
+    that proves the path optimal.
+    Returns the same arrays as search, came_from and cost_so_far of the
+    nodes of the path lead from start_node to goal_node. goal_node
+    is closed only when the path is found.
+    '''
+
+    size = grid.size
+    offsets = grid.offsets
+    cost = memoryview(grid.cost)
+
+    cost_so_far = np.full(size, -1, dtype=np.int64)
+    came_from = np.full(size, -1, dtype=np.int64)
+    closed = np.zeros(size, dtype=np.bool_)
+    # the backward search goes to the node from the nodes next to it,
+    # so the step costs the cost of the node it leaves
+    cost_to_goal = np.full(size, -1, dtype=np.int64)
+    goes_to = np.full(size, -1, dtype=np.int64)
+    closed_backward = np.zeros(size, dtype=np.bool_)
+    stop_view = None if stop is None else memoryview(stop)
+
+    # forward and backward directions of the search
+    directions = (
+        (memoryview(cost_so_far), memoryview(came_from),
+         memoryview(closed), memoryview(cost_to_goal), [start_node], 0),
+        (memoryview(cost_to_goal), memoryview(goes_to),
+         memoryview(closed_backward), memoryview(cost_so_far),
+         [goal_node], 1),
+        )
+    directions[0][0][start_node] = 0
+    directions[1][0][goal_node] = 0
+
+    if start_node == goal_node:
+        best_cost = 0
+        meeting_node = start_node
+    else:
+        best_cost = -1
+        meeting_node = -1
+    expanded = 0
+
+    while directions[0][4] and directions[1][4]:
+        top_forward = directions[0][4][0] // size
+        top_backward = directions[1][4][0] // size
+        if best_cost >= 0 and top_forward + top_backward >= best_cost:
+            break
+
+        costs, parents, closed_view, other_costs, frontier, backward = \
+            directions[top_forward > top_backward]
+
+        current_cost, current = divmod(heappop(frontier), size)
+        if closed_view[current]:
+            # stale duplicate of already expanded node
+            continue
+        closed_view[current] = True
+
+        if stop_view is not None and stop_view[current]:
+            best_cost = -1
+            break
+
+        expanded += 1
+        if is_canceled is not None \
+                and expanded % CANCEL_CHECK_INTERVAL == 0 \
+                and is_canceled():
+            return None
+
+        leave_cost = cost[current] if backward else 0
+        for offset in offsets:
+            next = current + offset
+            step_cost = cost[next]
+            if step_cost == WALL or closed_view[next]:
+                continue
+            if backward:
+                step_cost = leave_cost
+
+            new_cost = current_cost + step_cost
+            old_cost = costs[next]
+            if old_cost < 0 or new_cost < old_cost:
+                costs[next] = new_cost
+                parents[next] = current
+                heappush(frontier, new_cost * size + next)
+
+                if other_costs[next] >= 0:
+                    path_cost = new_cost + other_costs[next]
+                    if best_cost < 0 or path_cost < best_cost:
+                        best_cost = path_cost
+                        meeting_node = next
+
+    closed |= closed_backward
+    closed[goal_node] = False
+    if best_cost < 0:
+        return came_from, cost_so_far, closed
+
+    # continue the parents of the forward search to the goal
+    current = meeting_node
+    while current != goal_node:
+        next = int(goes_to[current])
+        came_from[next] = current
+        cost_so_far[next] = cost_so_far[current] + grid.cost[next]
+        current = next
+    closed[goal_node] = True
+
+    return came_from, cost_so_far, closed
+
+
+def find_path(grid, start, goal, is_canceled=None,
+              heuristic='manhattan', epsilon=0, bidirectional=False):
+    '''
+    Finds the best path from start to goal on the SearchGrid.
+    Returns a tuple (path, cost), where path is a list of (i, j) cells,
+    or None if the search was canceled by is_canceled callable.
+    If bidirectional is True, search_bidirectional is used
+    and the heuristic is ignored.
+    '''
+
+    start_node = grid.node(start)
+    goal_node = grid.node(goal)
+
+    if bidirectional:
+        result = search_bidirectional(grid, start_node, goal_node,
+                                      is_canceled)
+    else:
+        result = search(grid, start_node, goal_node, is_canceled,
+                        heuristic=heuristic, epsilon=epsilon)
+    if result is None:
+        return None
+    came_from, cost_so_far, _ = result
+
+    path = reconstruct_path(grid, came_from, start_node, goal_node)
+
+    return path, int(cost_so_far[goal_node])
+
+
+def search_many(grid, start_node, goal_nodes, is_canceled=None,
+                stop=None):
+    '''
+    Runs Dijkstra on the SearchGrid from start_node until all
+    goal_nodes are expanded, so one shortest path tree gives
+    the best paths to all of them.
+    Returns the same arrays as search, or None if canceled.
+    If the search was interrupted by stop, some of the goal_nodes
+    are not closed.
+    '''
+
+    size = grid.size
+    offsets = grid.offsets
+    cost = memoryview(grid.cost)
+
+    cost_so_far = np.full(size, -1, dtype=np.int64)
+    came_from = np.full(size, -1, dtype=np.int64)
+    closed = np.zeros(size, dtype=np.bool_)
+    cost_so_far_view = memoryview(cost_so_far)
+    came_from_view = memoryview(came_from)
+    closed_view = memoryview(closed)
+    stop_view = None if stop is None else memoryview(stop)
+
+    remaining = set(goal_nodes)
+
+    # items of the frontier are single ints: cost * size + node.
+    # The frontier is the binary heap and not a bucket queue: costs
+    # of color_diff go up to 195075, even for paletted and quantized
+    # rasters, so Dial's buckets don't fit them, and the radix heap
+    # written in python is about twice slower than heapq written in C
+    frontier = [start_node]
+    cost_so_far_view[start_node] = 0
+    expanded = 0
+
+    while frontier:
+        current_cost, current = divmod(heappop(frontier), size)
+
+        if closed_view[current]:
+            # stale duplicate of already expanded node
+            continue
+        closed_view[current] = True
+
+        remaining.discard(current)
+        if not remaining:
+            break
+
+        if stop_view is not None and stop_view[current]:
+            break
+
+        expanded += 1
+        if is_canceled is not None \
+                and expanded % CANCEL_CHECK_INTERVAL == 0 \
+                and is_canceled():
+            return None
+
+        for offset in offsets:
+            next = current + offset
+            step_cost = cost[next]
+            if step_cost == WALL or closed_view[next]:
+                continue
+
+            new_cost = current_cost + step_cost
+            old_cost = cost_so_far_view[next]
+            if old_cost < 0 or new_cost < old_cost:
+                cost_so_far_view[next] = new_cost
+                came_from_view[next] = current
+                heappush(frontier, new_cost * size + next)
+
+    return came_from, cost_so_far, closed
+
+
+def get_window(shape, points, margin):
+    '''
+    Returns window (i0, i1, j0, j1) that bounds (i, j) points
+    with the given margin and is clipped by the shape of the grid.
+    '''
+
+    size_i, size_j = shape
+    ii = [i for i, _ in points]
+    jj = [j for _, j in points]
+    return (max(min(ii) - margin, 0),
+            min(max(ii) + margin + 1, size_i),
+            max(min(jj) - margin, 0),
+            min(max(jj) + margin + 1, size_j))
+
+
+def get_window_sides(grid, window, shape):
+    '''
+    Returns boolean array indexed by node id of the SearchGrid built
+    over the window, that marks cells on the sides of the window
+    that are not the sides of the whole grid. Only through these
+    cells the search could leave the window.
+    '''
+
+    i0, i1, j0, j1 = window
+    size_i, size_j = shape
+    sides = np.zeros((grid.size_i + 2, grid.width), dtype=np.bool_)
+    inner = sides[1:-1, 1:-1]
+    if i0 > 0:
+        inner[0, :] = True
+    if i1 < size_i:
+        inner[-1, :] = True
+    if j0 > 0:
+        inner[:, 0] = True
+    if j1 < size_j:
+        inner[:, -1] = True
+
+    return sides.ravel()
+
+
+def is_last_window(window, shape):
+    '''
+    Returns True if the window can't be grown any more.
+    '''
+
+    i0, i1, j0, j1 = window
+    return window == (0, shape[0], 0, shape[1]) or \
+        (i1 - i0) * (j1 - j0) >= MAX_WINDOW_AREA
+
+
+def find_path_in_window(graph, start, goal, margin, is_canceled=None,
+                        heuristic='manhattan', epsilon=0,
+                        bidirectional=False):
+    '''
+    Finds the best path from start to goal searching only inside
+    the bounding box of start and goal extended by margin.
+    Once the search reaches the sides of the box, its result
+    may differ from the search over the whole grid, so the search
+    is interrupted, the margin is grown WINDOW_GROWTH times and
+    the search is repeated. The window is grown up to MAX_WINDOW_AREA.
+    The estimates of the heuristic are computed from the costs
+    inside the current window.
+    Returns (path, cost) or None if the search was canceled.
+    '''
+
+    shape = graph.shape
+    while True:
+        window = get_window(shape, (start, goal), margin)
+        i0, i1, j0, j1 = window
+        grid = SearchGrid(graph[i0:i1, j0:j1])
+        start_node = grid.node((start[0] - i0, start[1] - j0))
+        goal_node = grid.node((goal[0] - i0, goal[1] - j0))
+
+        last = is_last_window(window, shape)
+        stop = None if last else get_window_sides(grid, window, shape)
+        if bidirectional:
+            result = search_bidirectional(grid, start_node, goal_node,
+                                          is_canceled, stop=stop)
+        else:
+            result = search(grid, start_node, goal_node, is_canceled,
+                            stop=stop, heuristic=heuristic, epsilon=epsilon)
+        if result is None:
+            return None
+        came_from, cost_so_far, closed = result
+
+        if closed[goal_node] or last:
+            break
+        margin = max(margin * WINDOW_GROWTH, 1)
+
+    path = [(i + i0, j + j0) for i, j in
+            reconstruct_path(grid, came_from, start_node, goal_node)]
+
+    return path, int(cost_so_far[goal_node])
+
+
+def find_paths_in_window(graph, start, goals, margin, is_canceled=None):
+    '''
+    Finds the best paths from start to each of goals with a single
+    search inside the bounding box of all points extended by margin.
+    The box is grown the same way as in find_path_in_window.
+    Returns list of (path, cost) in the order of goals
+    or None if the search was canceled.
+    '''
+
+    shape = graph.shape
+    while True:
+        window = get_window(shape, [start] + list(goals), margin)
+        i0, i1, j0, j1 = window
+        grid = SearchGrid(graph[i0:i1, j0:j1])
+        start_node = grid.node((start[0] - i0, start[1] - j0))
+        goal_nodes = [grid.node((i - i0, j - j0)) for i, j in goals]
+
+        last = is_last_window(window, shape)
+        stop = None if last else get_window_sides(grid, window, shape)
+        result = search_many(grid, start_node, goal_nodes, is_canceled,
+                             stop=stop)
+        if result is None:
+            return None
+        came_from, cost_so_far, closed = result
+
+        if closed[goal_nodes].all() or last:
             break
+        margin = max(margin * WINDOW_GROWTH, 1)
+
+    results = []
+    for goal_node in goal_nodes:
+        path = [(i + i0, j + j0) for i, j in
+                reconstruct_path(grid, came_from, start_node, goal_node)]
+        results.append((path, int(cost_so_far[goal_node])))
+
+    return results
+
+
+def coarsen(costs, factor):
+    '''
+    Returns the grid factor times smaller than costs. A cell of it
+    costs the smallest cost in its block times factor, so the thin
+    lines stay cheap on the coarse grid.
+    '''
+
+    size_i, size_j = costs.shape
+    costs = np.pad(costs, ((0, -size_i % factor), (0, -size_j % factor)),
+                   mode='edge')
+    size_i, size_j = costs.shape
+    blocks = costs.reshape(size_i // factor, factor, size_j // factor, factor)
+    return blocks.min(axis=(1, 3)) * factor
+
+
+class CoarseGrid:
+    '''
+    2D grid of costs factor times smaller than the given grid,
+    see coarsen. The coarse tiles are computed only when they are
+    requested, each of them from its own block of the full grid,
+    so the full grid is never read at once. The least recently used
+    tiles are dropped while all tiles take more than the budget.
+    Supports slicing as grid[i0:i1, j0:j1], which returns numpy array.
+    '''
+
+    def __init__(self, graph, factor, budget=COARSE_GRID_BUDGET):
+        size_i, size_j = graph.shape
+        self.graph = graph
+        self.factor = factor
+        self.shape = -(-size_i // factor), -(-size_j // factor)
+        self.dtype = np.dtype(np.int64)
+        self.budget = budget
+        self.tiles = OrderedDict()
+        self.nbytes = 0
+        self.lock = Lock()
+
+    def get_tile(self, ti, tj):
+        '''
+        Returns the coarse tile with indexes (ti, tj),
+        coarsening its block of the full grid if needed.
+        '''
+
+        with self.lock:
+            tile = self.tiles.get((ti, tj))
+            if tile is not None:
+                self.tiles.move_to_end((ti, tj))
+                return tile
+
+        size = COARSE_TILE_SIZE * self.factor
+        costs = self.graph[ti * size:(ti + 1) * size,
+                           tj * size:(tj + 1) * size]
+        tile = coarsen(costs, self.factor).astype(self.dtype)
+
+        with self.lock:
+            if (ti, tj) not in self.tiles:
+                self.tiles[(ti, tj)] = tile
+                self.nbytes += tile.nbytes
+            while len(self.tiles) > 1 and self.nbytes > self.budget:
+                _, dropped = self.tiles.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+        return tile
+
+    def __getitem__(self, key):
+        return read_tiled(self.shape, (COARSE_TILE_SIZE, COARSE_TILE_SIZE),
+                          key, self.get_tile, self.dtype)
+
+
+def get_coarse_grid(graph, factor):
+    '''
+    Returns CoarseGrid of the graph. The grids are kept in coarse_grids
+    dict of the graph if it has one, so the coarse tiles are reused
+    by the following searches over the same graph.
+    '''
+
+    coarse_grids = getattr(graph, 'coarse_grids', None)
+    if coarse_grids is None:
+        return CoarseGrid(graph, factor)
+    coarse = coarse_grids.get(factor)
+    if coarse is None:
+        coarse = coarse_grids[factor] = CoarseGrid(graph, factor)
+    return coarse
+
+
+def get_corridor(coarse_shape, coarse_path, factor, shape):
+    '''
+    Returns boolean mask of the given shape that marks the blocks
+    of the coarse path together with the blocks next to them.
+    '''
+
+    path = np.zeros(coarse_shape, dtype=np.bool_)
+    path[tuple(np.array(coarse_path).T)] = True
+
+    corridor = path.copy()
+    corridor[1:, :] |= path[:-1, :]
+    corridor[:-1, :] |= path[1:, :]
+    corridor[:, 1:] |= path[:, :-1]
+    corridor[:, :-1] |= path[:, 1:]
+
+    corridor = corridor.repeat(factor, axis=0).repeat(factor, axis=1)
+    return corridor[:shape[0], :shape[1]]
+
+
+def get_cheapest_cell(graph, block, factor):
+    '''
+    Returns the cell of the graph with the smallest cost
+    inside the given block of the coarse grid.
+    '''
+
+    i0, j0 = block[0] * factor, block[1] * factor
+    costs = graph[i0:i0 + factor, j0:j0 + factor]
+    i, j = np.unravel_index(np.argmin(costs), costs.shape)
+    return i0 + int(i), j0 + int(j)
+
+
+def find_path_in_corridor(graph, start, goal, blocks, factor,
+                          is_canceled=None,
+                          heuristic='manhattan', epsilon=0):
+    '''
+    Finds the path from start to goal on the full grid only through
+    the given blocks of the coarse path and the blocks next to them.
+    Only the costs of the bounding box of the blocks are read.
+    Returns (path, cost) or None if the search was canceled.
+    '''
 
-        for next in get_neighbors(size_i, size_j, current):
-            # check isCanceled() to handle cancellation
+    coarse_i = [i for i, _ in blocks]
+    coarse_j = [j for _, j in blocks]
+    coarse_i0, coarse_j0 = max(min(coarse_i) - 1, 0), max(min(coarse_j) - 1, 0)
+    i0, j0 = coarse_i0 * factor, coarse_j0 * factor
+    i1 = min((max(coarse_i) + 2) * factor, graph.shape[0])
+    j1 = min((max(coarse_j) + 2) * factor, graph.shape[1])
 
-            new_cost = cost_so_far[current] + get_cost(graph, current, next)
-            if next not in cost_so_far or new_cost < cost_so_far[next]:
-                cost_so_far[next] = new_cost
-                priority = new_cost + heuristic(goal, next)
-                frontier.put(next, priority)
-                came_from[next] = current
+    costs = graph[i0:i1, j0:j1]
+    coarse_shape = -(-(i1 - i0) // factor), -(-(j1 - j0) // factor)
+    coarse_path = [(i - coarse_i0, j - coarse_j0) for i, j in blocks]
+    corridor = get_corridor(coarse_shape, coarse_path, factor, costs.shape)
 
-    path = reconstruct_path(came_from, start, goal)
+    grid = SearchGrid(np.where(corridor, costs, WALL))
+    start_node = grid.node((start[0] - i0, start[1] - j0))
+    goal_node = grid.node((goal[0] - i0, goal[1] - j0))
 
-    return path, cost_so_far[goal]
+    result = search(grid, start_node, goal_node, is_canceled,
+                    heuristic=heuristic, epsilon=epsilon)
+    if result is None:
+        return None
+    came_from, cost_so_far, _ = result
+
+    path = [(i + i0, j + j0) for i, j in
+            reconstruct_path(grid, came_from, start_node, goal_node)]
+
+    return path, int(cost_so_far[goal_node])
+
+
+def find_path_coarse_to_fine(graph, start, goal, factor, margin,
+                             is_canceled=None,
+                             heuristic='manhattan', epsilon=0):
+    '''
+    Finds the path from start to goal first on CoarseGrid of the graph,
+    with the window around start and goal extended by margin and grown
+    as in find_path_in_window, and then on the full grid only inside
+    the corridor of the blocks along the coarse path. The corridor is
+    refined by pieces of COARSE_SEGMENT_BLOCKS blocks joined at the
+    cheapest cells of the blocks between them, so only the costs near
+    the coarse path are read at full resolution.
+    Returns (path, cost) or None if the search was canceled.
+    '''
+
+    coarse = get_coarse_grid(graph, factor)
+    coarse_start = start[0] // factor, start[1] // factor
+    coarse_goal = goal[0] // factor, goal[1] // factor
+    result = find_path_in_window(coarse, coarse_start, coarse_goal,
+                                 max(margin // factor, 1), is_canceled,
+                                 heuristic=heuristic, epsilon=epsilon)
+    if result is None:
+        return None
+    coarse_path, _ = result
+
+    last = len(coarse_path) - 1
+    joints = list(range(0, last, COARSE_SEGMENT_BLOCKS)) + [last]
+    if last == 0:
+        joints = [0, 0]
+    cells = [start] + [get_cheapest_cell(graph, coarse_path[k], factor)
+                       for k in joints[1:-1]] + [goal]
+
+    path = [start]
+    cost = 0
+    for n in range(len(joints) - 1):
+        blocks = coarse_path[joints[n]:joints[n + 1] + 1]
+        result = find_path_in_corridor(graph, cells[n], cells[n + 1],
+                                       blocks, factor, is_canceled,
+                                       heuristic=heuristic, epsilon=epsilon)
+        if result is None:
+            return None
+        piece, piece_cost = result
+        path += piece[1:]
+        cost += piece_cost
+
+    return path, cost
+
+
+def FindPathFunction(graph, start, goal, window_margin=None,
+                     heuristic='manhattan', epsilon=0, bidirectional=False):
+    '''
+    Finds the best path from start to goal on 2D grid of costs.
+    If window_margin is given, the search is bounded by the window
+    around start and goal, see find_path_in_window.
+    heuristic and epsilon are passed to get_estimates.
+    bidirectional chooses search_bidirectional instead of A*.
+    '''
+
+    if window_margin is None:
+        return find_path(SearchGrid(graph), start, goal,
+                         heuristic=heuristic, epsilon=epsilon,
+                         bidirectional=bidirectional)
+
+    return find_path_in_window(graph, start, goal, window_margin,
+                               heuristic=heuristic, epsilon=epsilon,
+                               bidirectional=bidirectional)
+
+
+def FindPathsFunction(graph, start, goals, window_margin=None):
+    '''
+    Finds the best paths from start to each of goals on 2D grid
+    of costs with a single search. Returns list of (path, cost).
+    '''
+
+    if window_margin is None:
+        size_i, size_j = graph.shape
+        window_margin = max(size_i, size_j)
+
+    return find_paths_in_window(graph, start, goals, window_margin)
 
 
 class FindPathTask(QgsTask):
@@ -83,13 +852,24 @@ class FindPathTask(QgsTask):
     '''
 
 
-    def __init__(self, graph, start, goal, callback, vlayer):
+    def __init__(self, graph, start, goal, callback, vlayer,
+                 window_margin=None, heuristic='manhattan', epsilon=0,
+                 bidirectional=False, tile_graph=None, coarse_factor=None):
         '''
         Receives: graph - 2D grid of points
         start - coordinates of start point
         goal - coordinates of finish point
         callback - function to call after finishing tracing
         vlayer - vector layer for callback function
+        window_margin - margin of the search window around
+        start and goal, None to search over the whole grid
+        heuristic, epsilon - choice of the heuristic,
+        see get_estimates
+        bidirectional - search from both start and goal
+        tile_graph - hierarchical.TileGraph of the graph to route
+        long paths over, other search options are not used then
+        coarse_factor - if given, the path is found coarse to fine,
+        see find_path_coarse_to_fine, tile_graph is not used then
         '''
 
         super().__init__(
@@ -102,6 +882,12 @@ class FindPathTask(QgsTask):
         self.path = None
         self.callback = callback
         self.vlayer = vlayer
+        self.window_margin = window_margin
+        self.heuristic = heuristic
+        self.epsilon = epsilon
+        self.bidirectional = bidirectional
+        self.tile_graph = tile_graph
+        self.coarse_factor = coarse_factor
 
     def run(self):
         '''
@@ -109,38 +895,44 @@ class FindPathTask(QgsTask):
         i.e. finding the best path from start to goal
         '''
 
-        graph = self.graph
-        start = self.start
-        goal = self.goal
-
-        frontier = PriorityQueue()
-        frontier.put(start, 0)
-        came_from = {}
-        cost_so_far = {}
-        came_from[start] = None
-        cost_so_far[start] = 0
-
-        size_i, size_j = graph.shape
-
-        while not frontier.empty():
-            current = frontier.get()
-
-            if current == goal:
-                break
-
-            for next in get_neighbors(size_i, size_j, current):
-                # check isCanceled() to handle cancellation
-                if self.isCanceled():
-                    return False
-
-                new_cost = cost_so_far[current] + get_cost(graph, current, next)
-                if next not in cost_so_far or new_cost < cost_so_far[next]:
-                    cost_so_far[next] = new_cost
-                    priority = new_cost + heuristic(goal, next)
-                    frontier.put(next, priority)
-                    came_from[next] = current
-
-        self.path = reconstruct_path(came_from, start, goal)
+        if self.coarse_factor is not None:
+            result = find_path_coarse_to_fine(self.graph,
+                                              self.start,
+                                              self.goal,
+                                              self.coarse_factor,
+                                              self.window_margin or 0,
+                                              is_canceled=self.isCanceled,
+                                              heuristic=self.heuristic,
+                                              epsilon=self.epsilon,
+                                              )
+        elif self.tile_graph is not None:
+            result = self.tile_graph.find_path(self.start,
+                                               self.goal,
+                                               is_canceled=self.isCanceled,
+                                               )
+        elif self.window_margin is None:
+            result = find_path(SearchGrid(self.graph),
+                               self.start,
+                               self.goal,
+                               is_canceled=self.isCanceled,
+                               heuristic=self.heuristic,
+                               epsilon=self.epsilon,
+                               bidirectional=self.bidirectional,
+                               )
+        else:
+            result = find_path_in_window(self.graph,
+                                         self.start,
+                                         self.goal,
+                                         self.window_margin,
+                                         is_canceled=self.isCanceled,
+                                         heuristic=self.heuristic,
+                                         epsilon=self.epsilon,
+                                         bidirectional=self.bidirectional,
+                                         )
+        if result is None:
+            return False
+
+        self.path, _ = result
 
         return True
 
@@ -162,12 +954,17 @@ class FindPathTask(QgsTask):
         super().cancel()
 
 
-def reconstruct_path(came_from, start, goal):
+def reconstruct_path(grid, came_from, start, goal):
+    '''
+    Walks parent pointers back from goal to start.
+    Receives node ids and returns list of (i, j) cells.
+    '''
+
     current = goal
     path = []
     while current != start:
-        path.append(current)
-        current = came_from[current]
-    path.append(start) # optional
+        path.append(grid.ij(current))
+        current = int(came_from[current])
+    path.append(grid.ij(start)) # optional
     path.reverse() # optional
     return path
@@ -55,16 +55,9 @@ class AutotraceSubTask(QgsTask):
 
         points = self.search_near_points((i1, j1), direction, distance)
 
-        costs = []
-        paths = []
-
-        for point in points:
-            i2, j2 = point
-            # x2, y2 = self.pointtool.to_coords(i2, j2)
-
-            path, cost = self.pointtool.trace_over_image((i1, j1), (i2, j2))
-            costs.append(cost)
-            paths.append(path)
+        results = self.pointtool.trace_over_image_to_points((i1, j1), points)
+        paths = [path for path, _ in results]
+        costs = [cost for _, cost in results]
 
         min_cost = min(costs)
         min_cost_index = costs.index(min_cost)
@@ -0,0 +1,249 @@
+'''
+Module contains lazily evaluated grid of costs
+that is used for tracing along the color.
+'''
+
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+from qgis.core import Qgis, QgsMessageLog
+
+from .utils import read_tiled, widen, LookupBand
+
+# size of the square tile in which the costs are computed at once
+TILE_SIZE = 256
+
+# how many bytes of computed tiles CostGridCache may keep
+COST_GRID_CACHE_BUDGET = 256 * 1024 ** 2
+
+# how many bytes of computed tiles a single CostGrid may keep,
+# so tracing over large mosaics keeps only the tiles near the search
+COST_GRID_BUDGET = 128 * 1024 ** 2
+
+# width of the bins the target colors are quantized by in CostGridCache,
+# given for 8-bit bands and scaled to the range of other integer types
+COLOR_QUANTIZATION = 8
+
+
+def color_diff(sample, color):
+    '''
+    Squared distance between colors of the pixels and the target color.
+    '''
+
+    r, g, b = sample
+    r0, g0, b0 = color
+    return (r0 - r) ** 2 + (g0 - g) ** 2 + (b0 - b) ** 2
+
+
+def gray_diff(sample, color):
+    '''
+    Squared difference between gray levels of the pixels
+    and the gray level of the target color.
+    '''
+
+    r, g, b = sample
+    r0, g0, b0 = color
+    return ((r0 + g0 + b0) / 3 - (r + g + b) / 3) ** 2
+
+
+# possible ways of converting colors of the raster to costs
+COST_MODES = {
+    'color_diff': color_diff,
+    'gray_diff': gray_diff,
+    }
+
+
+def get_cost_table(sample, color, cost_function):
+    '''
+    Returns costs of all entries of the tables if the sample consists
+    of LookupBands over the same band, or None otherwise.
+    '''
+
+    if not all(isinstance(band, LookupBand) for band in sample):
+        return None
+    if any(band.band is not sample[0].band for band in sample):
+        return None
+
+    # NaNs of nodata become zeros the same way as in widen
+    tables = tuple(np.nan_to_num(band.table.astype(float))
+                   for band in sample)
+    return np.abs(cost_function(tables, color)).astype(np.int64)
+
+
+class CostGrid:
+    '''
+    2D grid of costs of moving through the pixels of the sample.
+    The cost of the pixel is given by the function from COST_MODES
+    applied to its color and the target color. Costs are computed
+    only for the tiles that are actually requested. The least recently
+    used tiles are dropped while all tiles take more than the budget
+    and are computed again if requested later.
+    For paletted and gray rasters the costs are computed once per entry
+    of the table and the tiles are gathered from them by the indexes.
+    Supports slicing as grid[i0:i1, j0:j1], which returns numpy array.
+    '''
+
+    def __init__(self, sample, color, mode='color_diff',
+                 budget=COST_GRID_BUDGET):
+        '''
+        sample - tuple (r, g, b) of 2D array-like bands of the raster,
+        they are converted to floats only inside the computed tiles
+        color - target color as a tuple (r, g, b)
+        mode - name of the cost function from COST_MODES
+        budget - how many bytes of computed tiles to keep
+        '''
+
+        self.sample = sample
+        self.color = color
+        self.mode = mode
+        self.cost_function = COST_MODES[mode]
+        self.shape = sample[0].shape
+        self.dtype = np.dtype(np.int64)
+        self.budget = budget
+        self.cost_table = get_cost_table(sample, color, self.cost_function)
+        self.tiles = OrderedDict()
+        self.nbytes = 0
+        # CoarseGrids of this grid by their factors, see astar
+        self.coarse_grids = {}
+        # tiles are requested both by the searches on the background
+        # and by the main thread
+        self.lock = Lock()
+
+    def get_tile(self, ti, tj):
+        '''
+        Returns costs of the tile with indexes (ti, tj),
+        computing them if needed.
+        '''
+
+        with self.lock:
+            tile = self.tiles.get((ti, tj))
+            if tile is not None:
+                self.tiles.move_to_end((ti, tj))
+                return tile
+
+        window = (slice(ti * TILE_SIZE, (ti + 1) * TILE_SIZE),
+                  slice(tj * TILE_SIZE, (tj + 1) * TILE_SIZE))
+        if self.cost_table is not None:
+            tile = self.cost_table[self.sample[0].band[window]]
+        else:
+            sample = tuple(widen(band, window) for band in self.sample)
+            tile = np.abs(self.cost_function(sample, self.color))
+            tile = tile.astype(self.dtype)
+
+        with self.lock:
+            if (ti, tj) not in self.tiles:
+                self.tiles[(ti, tj)] = tile
+                self.nbytes += tile.nbytes
+            while len(self.tiles) > 1 and self.nbytes > self.budget:
+                _, dropped = self.tiles.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+        return tile
+
+    def __getitem__(self, key):
+        return read_tiled(self.shape, (TILE_SIZE, TILE_SIZE), key,
+                          self.get_tile, self.dtype)
+
+
+def get_value_range(sample):
+    '''
+    Returns (low, high) range of the values of the bands of the sample
+    given by their integer data type, or None if the values are not
+    limited, e.g. for float data or for colors looked up in the tables.
+    '''
+
+    if any(isinstance(band, LookupBand) for band in sample):
+        return None
+    dtype = np.dtype(getattr(sample[0], 'dtype', np.float64))
+    if not np.issubdtype(dtype, np.integer):
+        return None
+    info = np.iinfo(dtype)
+    return int(info.min), int(info.max)
+
+
+class CostGridCache:
+    '''
+    Least recently used cache of CostGrids of the sample.
+    Grids are keyed by the target color and by the cost mode. For bands
+    of integer types the color is quantized to bins of COLOR_QUANTIZATION
+    width scaled to the range of the type. Colors of paletted rasters
+    come from the palette and colors of float rasters have no fixed
+    range, so they are used as they are. The least recently used grids
+    are dropped while the tiles of all grids take more than the budget.
+    Counts hits and misses for tuning quantization, see log_stats.
+    '''
+
+    def __init__(self, sample,
+                 budget=COST_GRID_CACHE_BUDGET,
+                 quantization=COLOR_QUANTIZATION):
+        self.sample = sample
+        self.budget = budget
+        self.quantization = quantization
+        self.value_range = get_value_range(sample)
+        self.grids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, color, mode='color_diff'):
+        '''
+        Returns CostGrid for the color and the mode. The grid
+        is built for the center of the bin the color falls in.
+        '''
+
+        if self.value_range is None:
+            key = tuple(float(c) for c in color), mode
+        else:
+            low, high = self.value_range
+            width = max(self.quantization * (high - low + 1) // 256, 1)
+            key = tuple(int(c - low) // width for c in color), mode
+
+        grid = self.grids.get(key)
+        if grid is None:
+            self.misses += 1
+            if self.value_range is not None:
+                color = tuple(min(low + k * width + width // 2, high)
+                              for k in key[0])
+            grid = CostGrid(self.sample, color, mode)
+            self.grids[key] = grid
+        else:
+            self.hits += 1
+            self.grids.move_to_end(key)
+
+        self.evict()
+        return grid
+
+    def log_stats(self):
+        '''
+        Writes the hits and misses of the cache
+        to the message log of QGIS.
+        '''
+
+        lookups = self.hits + self.misses
+        if not lookups:
+            return
+        QgsMessageLog.logMessage(
+            "Cost grids: {} hits, {} misses ({:.0%} hit rate), "
+            "{} grids kept in {:.1f} MiB".format(
+                self.hits, self.misses, self.hits / lookups,
+                len(self.grids), self.nbytes / 1024 ** 2),
+            'Raster Tracer',
+            level=Qgis.Info,
+            )
+
+    @property
+    def nbytes(self):
+        '''
+        Memory occupied by the computed tiles of all grids.
+        '''
+
+        return sum(grid.nbytes for grid in self.grids.values())
+
+    def evict(self):
+        '''
+        Drops least recently used grids until the cache fits
+        the budget. The most recent grid is always kept.
+        '''
+
+        while len(self.grids) > 1 and self.nbytes > self.budget:
+            self.grids.popitem(last=False)
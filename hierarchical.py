@@ -0,0 +1,375 @@
+'''
+Module performs hierarchical searching of the path on 2D grid
+of costs for long distances, similar to HPA* method.
+The grid is split into square tiles. Cells on both sides of the
+border between neighboring tiles are chosen as entrances, and the
+costs of the best paths between entrances of the same tile are
+computed once per tile. Long paths are first found on the abstract
+graph of entrances and then refined inside the tiles along it.
+'''
+
+from heapq import heappush, heappop
+
+from qgis.core import QgsTask
+
+from .astar import SearchGrid, search_many, reconstruct_path, \
+                   find_path_in_window
+
+# size of the square tile of the abstract graph
+HPA_TILE_SIZE = 64
+
+# length of the part of the tile border with one entrance
+ENTRANCE_SPACING = 32
+
+# margin of the search window when start and goal are too close
+# for the abstract graph
+HPA_WINDOW_MARGIN = 32
+
+
+class TileGraph:
+    '''
+    Abstract graph of the entrances of the tiles of the cost grid.
+    Entrances and costs inside the tiles are computed when the tiles
+    are needed first time and are kept until the graph is dropped,
+    so the graph has to be created again if the grid is changed.
+    '''
+
+    def __init__(self, graph,
+                 tile_size=HPA_TILE_SIZE,
+                 spacing=ENTRANCE_SPACING):
+        '''
+        graph - 2D grid of costs, numpy array or CostGrid
+        '''
+
+        self.graph = graph
+        self.shape = graph.shape
+        self.tile_size = tile_size
+        self.spacing = spacing
+        self.borders = {}
+        self.edges = {}
+
+    def tile_of(self, cell):
+        i, j = cell
+        return i // self.tile_size, j // self.tile_size
+
+    def tile_window(self, tile):
+        '''
+        Returns window (i0, i1, j0, j1) covered by the tile.
+        '''
+
+        ti, tj = tile
+        size = self.tile_size
+        size_i, size_j = self.shape
+        return (ti * size, min((ti + 1) * size, size_i),
+                tj * size, min((tj + 1) * size, size_j))
+
+    def tile_count(self):
+        size = self.tile_size
+        size_i, size_j = self.shape
+        return -(-size_i // size), -(-size_j // size)
+
+    def get_border(self, tile, vertical):
+        '''
+        Returns list of pairs of cells (a, b) that are entrances
+        across the border between the tile and its neighbor to the
+        right (vertical border) or below (horizontal border).
+        In every part of the border of ENTRANCE_SPACING length
+        the pair of cells of the smallest cost is chosen.
+        '''
+
+        key = tile, vertical
+        border = self.borders.get(key)
+        if border is not None:
+            return border
+
+        i0, i1, j0, j1 = self.tile_window(tile)
+        if vertical:
+            costs = self.graph[i0:i1, j1 - 1:j1 + 1].sum(axis=1)
+            start = i0
+        else:
+            costs = self.graph[i1 - 1:i1 + 1, j0:j1].sum(axis=0)
+            start = j0
+
+        border = []
+        for k0 in range(0, len(costs), self.spacing):
+            part = costs[k0:k0 + self.spacing]
+            k = start + k0 + int(part.argmin())
+            if vertical:
+                border.append(((k, j1 - 1), (k, j1)))
+            else:
+                border.append(((i1 - 1, k), (i1, k)))
+
+        self.borders[key] = border
+        return border
+
+    def get_links(self, tile):
+        '''
+        Returns list of pairs (entrance, cell) of the tile, where cell
+        is the entrance of the neighboring tile across the border.
+        '''
+
+        ti, tj = tile
+        count_i, count_j = self.tile_count()
+
+        links = []
+        if tj + 1 < count_j:
+            links += self.get_border(tile, True)
+        if ti + 1 < count_i:
+            links += self.get_border(tile, False)
+        if tj > 0:
+            links += [(b, a) for a, b in self.get_border((ti, tj - 1), True)]
+        if ti > 0:
+            links += [(b, a) for a, b in self.get_border((ti - 1, tj), False)]
+        return links
+
+    def costs_in_tile(self, tile, source, targets, is_canceled=None):
+        '''
+        Runs the search inside the tile from source to targets.
+        Returns (grid, came_from, cost_so_far) of the search
+        or None if it was canceled.
+        '''
+
+        i0, i1, j0, j1 = self.tile_window(tile)
+        grid = SearchGrid(self.graph[i0:i1, j0:j1])
+        source_node = grid.node((source[0] - i0, source[1] - j0))
+        target_nodes = [grid.node((i - i0, j - j0)) for i, j in targets]
+
+        result = search_many(grid, source_node, target_nodes, is_canceled)
+        if result is None:
+            return None
+        came_from, cost_so_far, _ = result
+        return grid, came_from, cost_so_far
+
+    def get_edges(self, tile, is_canceled=None):
+        '''
+        Returns dict {entrance: [(cell, cost), ...]} with edges of the
+        abstract graph that start at the entrances of the tile:
+        to other entrances of the tile and across the borders.
+        Returns None if the computation was canceled.
+        '''
+
+        edges = self.edges.get(tile)
+        if edges is not None:
+            return edges
+
+        links = self.get_links(tile)
+        entrances = list({a for a, _ in links})
+        i0, _, j0, _ = self.tile_window(tile)
+
+        edges = {entrance: [] for entrance in entrances}
+        for a, b in links:
+            edges[a].append((b, int(self.graph[b[0]:b[0] + 1,
+                                               b[1]:b[1] + 1][0, 0])))
+
+        for entrance in entrances:
+            result = self.costs_in_tile(tile, entrance, entrances,
+                                        is_canceled)
+            if result is None:
+                return None
+            grid, _, cost_so_far = result
+            for other in entrances:
+                if other != entrance:
+                    node = grid.node((other[0] - i0, other[1] - j0))
+                    edges[entrance].append((other, int(cost_so_far[node])))
+
+        self.edges[tile] = edges
+        return edges
+
+    def prepare(self, tiles, is_canceled=None):
+        '''
+        Computes edges of the given tiles in advance.
+        Returns False if it was canceled.
+        '''
+
+        for tile in tiles:
+            if is_canceled is not None and is_canceled():
+                return False
+            if self.get_edges(tile, is_canceled) is None:
+                return False
+        return True
+
+    def find_path(self, start, goal, is_canceled=None):
+        '''
+        Finds the path from start to goal on the abstract graph and
+        refines it inside the tiles along it. The path is the best
+        one that passes the tiles through their entrances.
+        Returns (path, cost) or None if the search was canceled.
+        '''
+
+        start_tile = self.tile_of(start)
+        goal_tile = self.tile_of(goal)
+        if abs(start_tile[0] - goal_tile[0]) + \
+                abs(start_tile[1] - goal_tile[1]) <= 1:
+            return find_path_in_window(self.graph, start, goal,
+                                       HPA_WINDOW_MARGIN, is_canceled)
+
+        start_edges = self.get_endpoint_edges(start_tile, start, True,
+                                              is_canceled)
+        goal_edges = self.get_endpoint_edges(goal_tile, goal, False,
+                                             is_canceled)
+        if start_edges is None or goal_edges is None:
+            return None
+
+        route = self.find_route(start, goal, start_edges, goal_edges,
+                                is_canceled)
+        if route is None:
+            return None
+        if not route:
+            return find_path_in_window(self.graph, start, goal,
+                                       HPA_WINDOW_MARGIN, is_canceled)
+
+        return self.refine(route, is_canceled)
+
+    def get_endpoint_edges(self, tile, cell, outgoing, is_canceled=None):
+        '''
+        Returns dict {entrance: cost} of the paths inside the tile from
+        the cell to its entrances if outgoing, or from the entrances
+        to the cell otherwise. Returns None if it was canceled.
+        '''
+
+        entrances = list({a for a, _ in self.get_links(tile)})
+        i0, _, j0, _ = self.tile_window(tile)
+
+        if outgoing:
+            result = self.costs_in_tile(tile, cell, entrances, is_canceled)
+            if result is None:
+                return None
+            grid, _, cost_so_far = result
+            return {entrance: int(cost_so_far[grid.node(
+                        (entrance[0] - i0, entrance[1] - j0))])
+                    for entrance in entrances}
+
+        costs = {}
+        for entrance in entrances:
+            result = self.costs_in_tile(tile, entrance, [cell], is_canceled)
+            if result is None:
+                return None
+            grid, _, cost_so_far = result
+            costs[entrance] = int(cost_so_far[grid.node(
+                (cell[0] - i0, cell[1] - j0))])
+        return costs
+
+    def find_route(self, start, goal, start_edges, goal_edges,
+                   is_canceled=None):
+        '''
+        Runs A* on the abstract graph from start to goal.
+        Returns list of cells of the route, empty list if the goal
+        can't be reached over the graph, or None if it was canceled.
+        '''
+
+        goal_i, goal_j = goal
+        frontier = [(0, 0, start)]
+        cost_so_far = {start: 0}
+        came_from = {start: None}
+        closed = set()
+
+        while frontier:
+            _, current_cost, current = heappop(frontier)
+            if current in closed:
+                continue
+            closed.add(current)
+
+            if current == goal:
+                break
+
+            if is_canceled is not None and is_canceled():
+                return None
+
+            edges = []
+            if current == start:
+                edges += start_edges.items()
+            # start may be an entrance itself, then it has the edges
+            # of the entrance across the border too
+            if current != start or current in start_edges:
+                tile_edges = self.get_edges(self.tile_of(current),
+                                            is_canceled)
+                if tile_edges is None:
+                    return None
+                edges += tile_edges[current]
+                if current in goal_edges:
+                    edges.append((goal, goal_edges[current]))
+
+            for next, cost in edges:
+                new_cost = current_cost + cost
+                if next not in cost_so_far or new_cost < cost_so_far[next]:
+                    cost_so_far[next] = new_cost
+                    came_from[next] = current
+                    priority = new_cost + abs(goal_i - next[0]) + \
+                        abs(goal_j - next[1])
+                    heappush(frontier, (priority, new_cost, next))
+
+        if goal not in came_from:
+            return []
+
+        route = [goal]
+        while route[-1] != start:
+            route.append(came_from[route[-1]])
+        route.reverse()
+        return route
+
+    def refine(self, route, is_canceled=None):
+        '''
+        Replaces the steps of the route inside the tiles
+        by the paths on the grid.
+        Returns (path, cost) or None if it was canceled.
+        '''
+
+        path = [route[0]]
+        cost = 0
+        for a, b in zip(route, route[1:]):
+            if abs(a[0] - b[0]) + abs(a[1] - b[1]) == 1 \
+                    and self.tile_of(a) != self.tile_of(b):
+                # step across the border
+                part = [a, b]
+            else:
+                tile = self.tile_of(a)
+                result = self.costs_in_tile(tile, a, [b], is_canceled)
+                if result is None:
+                    return None
+                grid, came_from, _ = result
+                i0, _, j0, _ = self.tile_window(tile)
+                part = [(i + i0, j + j0) for i, j in reconstruct_path(
+                    grid, came_from,
+                    grid.node((a[0] - i0, a[1] - j0)),
+                    grid.node((b[0] - i0, b[1] - j0)))]
+            for i, j in part[1:]:
+                cost += int(self.graph[i:i + 1, j:j + 1][0, 0])
+            path += part[1:]
+
+        return path, cost
+
+
+class TileGraphTask(QgsTask):
+    '''
+    Implementation of QGIS QgsTask
+    for computing tiles of TileGraph on the background.
+    '''
+
+    def __init__(self, tile_graph, tiles):
+        '''
+        Receives: tile_graph - TileGraph to prepare
+        tiles - list of (ti, tj) tiles to compute
+        '''
+
+        super().__init__(
+            'Task for preparing tiles for raster_tracer',
+            QgsTask.CanCancel
+                )
+        self.tile_graph = tile_graph
+        self.tiles = tiles
+
+    def run(self):
+        '''
+        Computes the edges of the tiles.
+        '''
+
+        return self.tile_graph.prepare(self.tiles,
+                                       is_canceled=self.isCanceled)
+
+    def cancel(self):
+        '''
+        Executed when run catches cancel signal.
+        Terminates the QgsTask.
+        '''
+
+        super().cancel()
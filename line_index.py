@@ -0,0 +1,103 @@
+'''
+Module contains spatial index of the lines of the vector layer
+that is kept up to date with the edits of the layer, so snapping
+to the traced lines doesn't read the whole layer.
+'''
+
+from qgis.core import QgsSpatialIndex, QgsFeature, QgsPointXY, \
+                      QgsRectangle
+
+
+class LineIndex:
+    '''
+    Spatial index of the features of the vector layer that stores
+    their geometries. Added, deleted and changed features, including
+    the ones changed by undo, are updated through the signals of the
+    layer. The index is built again after the edits are saved or
+    rolled back, since the ids of the features change then.
+    '''
+
+    def __init__(self, vlayer):
+        self.vlayer = vlayer
+        self.index = None
+        self.build()
+
+        self.connections = [
+            (vlayer.featureAdded, self.feature_added),
+            (vlayer.featureDeleted, self.feature_deleted),
+            (vlayer.geometryChanged, self.geometry_changed),
+            (vlayer.afterCommitChanges, self.build),
+            (vlayer.afterRollBack, self.build),
+            ]
+        for signal, slot in self.connections:
+            signal.connect(slot)
+
+    def build(self):
+        self.index = QgsSpatialIndex(
+            self.vlayer.getFeatures(),
+            flags=QgsSpatialIndex.FlagStoreFeatureGeometries,
+            )
+
+    def close(self):
+        '''
+        Stops following the edits of the layer.
+        '''
+
+        for signal, slot in self.connections:
+            try:
+                signal.disconnect(slot)
+            except (TypeError, RuntimeError):
+                # the layer is already deleted
+                pass
+        self.connections = []
+
+    def add(self, fid, geometry):
+        if geometry.isNull():
+            return
+        feature = QgsFeature(fid)
+        feature.setGeometry(geometry)
+        self.index.addFeature(feature)
+
+    def remove(self, fid):
+        self.index.deleteFeature(self.get_feature(fid))
+
+    def get_feature(self, fid):
+        '''
+        Returns feature with the geometry stored in the index.
+        '''
+
+        feature = QgsFeature(fid)
+        feature.setGeometry(self.index.geometry(fid))
+        return feature
+
+    def feature_added(self, fid):
+        self.add(fid, self.vlayer.getFeature(fid).geometry())
+
+    def feature_deleted(self, fid):
+        self.remove(fid)
+
+    def geometry_changed(self, fid, geometry):
+        self.remove(fid)
+        self.add(fid, geometry)
+
+    def closest_vertex(self, x, y, sq_tolerance):
+        '''
+        Returns (x, y) of the vertex of the lines closest to the point
+        within the squared tolerance, or None if there is no such vertex.
+        Only the lines whose bounding boxes are near the point are checked.
+        '''
+
+        tolerance = sq_tolerance ** 0.5
+        point = QgsPointXY(x, y)
+        rect = QgsRectangle(x - tolerance, y - tolerance,
+                            x + tolerance, y + tolerance)
+
+        closest = None
+        closest_distance = sq_tolerance
+        for fid in self.index.intersects(rect):
+            vertex, _, _, _, sq_distance = \
+                self.index.geometry(fid).closestVertex(point)
+            if sq_distance < closest_distance:
+                closest = vertex.x(), vertex.y()
+                closest_distance = sq_distance
+        return closest
@@ -3,23 +3,31 @@ Main functionality of raster tracer.
 '''
 
 from enum import Enum
+import os
 from collections import namedtuple
 import numpy as np
 
 from qgis.core import QgsPointXY, QgsPoint, QgsGeometry, QgsFeature, \
                       QgsVectorLayer, QgsProject, QgsWkbTypes, QgsApplication, \
-                      QgsRectangle, QgsSpatialIndex
+                      QgsRectangle
 from qgis.gui import QgsMapToolEmitPoint, QgsMapToolEdit, \
                      QgsRubberBand, QgsVertexMarker, QgsMapTool
-from qgis.PyQt.QtCore import Qt
+from qgis.PyQt.QtCore import Qt, QTimer
 from qgis.PyQt.QtGui import QColor
 from qgis.core import Qgis
 from qgis.core import QgsCoordinateTransform
 
 
-from .astar import FindPathTask, FindPathFunction
+from .astar import FindPathTask, FindPathFunction, FindPathsFunction
+from .cost_grid import CostGrid
+from .hierarchical import TileGraph, TileGraphTask
+from .raster_state import RasterState, RasterStateCache
+from .quantization import QuantizationTask
+from .line_index import LineIndex
 from .line_simplification import smooth, simplify
-from .utils import get_whole_raster, PossiblyIndexedImageError
+from .utils import get_transforms, BlockCache, RasterLoadTask, widen, \
+                   DiskCache, DiskCacheTask, LookupBand, transform_coords, \
+                   get_line_wkb, append_to_line_wkb
 from .pointtool_states import WaitingFirstPointState
 from .exceptions import OutsideMapError
 
@@ -29,6 +37,21 @@ Anchor = namedtuple('Anchor', ['x', 'y', 'i', 'j'])
 # Flag for experimental Autofollowing mode
 ALLOW_AUTO_FOLLOWING = False
 
+# Initial margin of the search window around start and goal in pixels
+SEARCH_WINDOW_MARGIN = 32
+
+# Manhattan distance in pixels from which the path is routed
+# over the tiles of the raster
+HIERARCHICAL_MIN_DISTANCE = 1024
+
+# tiles of the abstract graph are not prepared in advance when more
+# of them are visible, e.g. on the zoomed out mosaic
+MAX_PREPARED_TILES = 256
+
+# the rubber band and the snap marker follow the mouse at most once
+# per this many milliseconds, mouse moves in between are coalesced
+MOUSE_MOVE_INTERVAL = 30
+
 
 class TracingModes(Enum):
     '''
@@ -86,6 +109,7 @@ class PointTool(QgsMapToolEdit):
     '''
 
     def deactivate(self):
+        self.mouse_move_timer.stop()
         QgsMapTool.deactivate(self)
         self.deactivated.emit()
 
@@ -104,14 +128,47 @@ class PointTool(QgsMapToolEdit):
 
         # for keeping track of mouse event for rubber band updating
         self.last_mouse_event_pos = None
+        # position of the last mouse move that isn't processed yet
+        self.pending_mouse_pos = None
+        self.mouse_move_timer = QTimer()
+        self.mouse_move_timer.setSingleShot(True)
+        self.mouse_move_timer.setInterval(MOUSE_MOVE_INTERVAL)
+        self.mouse_move_timer.timeout.connect(self.process_mouse_move)
 
         self.tracing_mode = TracingModes.PATH
 
         self.turn_off_snap = turn_off_snap
         self.smooth_line = smooth
 
-        # possible variants: gray_diff, as_is, color_diff (using v from hsv)
-        self.grid_conversion = "gray_diff"
+        # possible variants are the keys of cost_grid.COST_MODES
+        self.grid_conversion = "color_diff"
+
+        # margin in pixels of the search window around start and goal,
+        # None to search over the whole raster
+        self.search_window_margin = SEARCH_WINDOW_MARGIN
+
+        # heuristic of the search, one of the keys of astar.HEURISTICS,
+        # and epsilon > 0 allows paths up to (1 + epsilon) times
+        # more expensive than the best one for the faster search
+        self.heuristic = "manhattan"
+        self.epsilon = 0
+
+        # search from both anchors at once, the heuristic is not used then
+        self.bidirectional = False
+
+        # if set, paths are found first on the raster coarsened
+        # this many times and then refined along the coarse path,
+        # also the long paths that are routed over the tiles otherwise
+        self.coarse_factor = None
+
+        # if set, colors of RGB rasters are reduced to the palette of
+        # this many colors, so the costs are computed once per color
+        self.quantize_colors = None
+
+        # if set, the line being traced is kept in memory and shown
+        # by the rubber band, and it's written to the vector layer
+        # only once when the line is finished
+        self.buffered = False
 
         # QApplication.restoreOverrideCursor()
         # QApplication.setOverrideCursor(Qt.CrossCursor)
@@ -122,8 +179,26 @@ class PointTool(QgsMapToolEdit):
         self.snap_tolerance = None # snap to color
         self.snap2_tolerance = None # snap to itself
         self.vlayer = None
-        self.grid = None
         self.sample = None
+        # blocks of the raster that were read from the file
+        self.block_cache = BlockCache()
+        # copies of the rasters that are opened faster than the rasters,
+        # None unless it is turned on by disk_cache_changed
+        self.disk_cache = None
+        self.disk_cache_task = None
+        # prepared rasters of the layers that were traced recently
+        self.raster_states = RasterStateCache()
+        # ids of the layers whose signals drop their states
+        self.watched_layers = set()
+        # cost grids for the colors under the goal points
+        self.cost_grid_cache = None
+        # abstract graph of tiles for long paths and its preparing task
+        self.tile_graph = None
+        self.tile_graph_task = None
+        # task that opens the raster on the background
+        self.raster_load_task = None
+        self.quantization_task = None
+        self.trace_color = False
 
         self.tracking_is_active = False
 
@@ -134,10 +209,26 @@ class PointTool(QgsMapToolEdit):
         self.marker_snap.setColor(QColor(255, 0, 255))
 
         self.find_path_task = None
+        # transform from the raster to the vector layer of the last path
+        self.vector_transform = None
+        # (layer id, feature id, geometry) of the line being traced,
+        # geometry is None when it has to be read from the layer again
+        self.traced_line = None
+        # ids of the vector layers whose signals drop the geometry
+        self.watched_vector_layers = set()
+        # set while the tool itself changes the traced line
+        self.changing_traced_line = False
+        # segments of the buffered line in the CRS of the vector layer
+        # and the rubber band that shows them
+        self.line_segments = []
+        self.line_band = QgsRubberBand(self.canvas(), QgsWkbTypes.LineGeometry)
+        self.line_band.setColor(QColor(255, 0, 0))
+        self.line_band.setWidth(2)
 
         self.change_state(WaitingFirstPointState)
 
-        self.last_vlayer = None
+        # spatial index of the lines of the current vector layer
+        self.line_index = None
 
     def display_message(self,
                         title,
@@ -175,33 +266,120 @@ class PointTool(QgsMapToolEdit):
             self.marker_snap.show()
 
     def snap2_tolerance_changed(self, snap_tolerance):
-        self.snap2_tolerance = snap_tolerance**2
+        if snap_tolerance is None:
+            self.snap2_tolerance = None
+        else:
+            self.snap2_tolerance = snap_tolerance**2
         # if snap_tolerance is None:
         #     self.marker_snap.hide()
         # else:
         #     self.marker_snap.show()
 
-    def trace_color_changed(self, color):
-        r, g, b = self.sample
+    def quantize_colors_changed(self, count):
+        '''
+        Sets how many colors RGB rasters are reduced to, None to trace
+        the original colors, and prepares the current raster again.
+        '''
+
+        if count == self.quantize_colors:
+            return
+        self.quantize_colors = count
+        if self.rlayer is not None:
+            self.raster_layer_data_changed(self.rlayer.id())
+
+    def buffered_changed(self, buffered):
+        '''
+        Turns the buffered mode on or off. The line that is
+        buffered at the moment is written to the active layer.
+        '''
 
-        if color is False:
+        if self.buffered and not buffered:
+            self.finish_line(self.iface.activeLayer())
+        self.buffered = buffered
+
+    def disk_cache_changed(self, enabled):
+        '''
+        Turns on or off keeping copies of the traced rasters
+        in the settings directory of QGIS.
+        '''
+
+        if not enabled:
+            self.disk_cache = None
+        elif self.disk_cache is None:
+            self.disk_cache = DiskCache(os.path.join(
+                QgsApplication.qgisSettingsDirPath(),
+                'cache', 'raster_tracer'))
+
+    def trace_color_changed(self, color):
+        self.trace_color = color
+        if color is False or self.sample is None:
             self.grid_changed = None
         else:
             r0, g0, b0, t = color.getRgb()
-            self.grid_changed = np.abs((r0 - r) ** 2 + (g0 - g) ** 2 +
-                                       (b0 - b) ** 2)
+            self.grid_changed = CostGrid(self.sample,
+                                         (r0, g0, b0),
+                                         self.grid_conversion,
+                                         )
+        self.drop_tile_graph()
+        if self.grid_changed is not None and self.coarse_factor is None:
+            self.prepare_tile_graph()
+
+    def drop_tile_graph(self):
+        '''
+        Forgets tiles computed for the previous color or raster.
+        '''
+
+        if self.tile_graph_task is not None:
+            try:
+                self.tile_graph_task.cancel()
+            except RuntimeError:
+                pass
+            self.tile_graph_task = None
+        self.tile_graph = None
+
+    def get_tile_graph(self, grid):
+        '''
+        Returns TileGraph of the given cost grid.
+        '''
+
+        if self.tile_graph is None or self.tile_graph.graph is not grid:
+            self.drop_tile_graph()
+            self.tile_graph = TileGraph(grid)
+        return self.tile_graph
+
+    def prepare_tile_graph(self):
+        '''
+        Computes the tiles of the trace color that are visible
+        on the canvas on the background.
+        '''
+
+        tile_graph = self.get_tile_graph(self.grid_changed)
+
+        extent = self.canvas().extent()
+        i0, j0 = self.to_indexes(extent.xMinimum(), extent.yMaximum())
+        i1, j1 = self.to_indexes(extent.xMaximum(), extent.yMinimum())
+        count_i, count_j = tile_graph.tile_count()
+        ti0, tj0 = tile_graph.tile_of((max(min(i0, i1), 0),
+                                       max(min(j0, j1), 0)))
+        ti1, tj1 = tile_graph.tile_of((max(i0, i1), max(j0, j1)))
+        ti1 = min(ti1 + 1, count_i)
+        tj1 = min(tj1 + 1, count_j)
+        if (ti1 - ti0) * (tj1 - tj0) > MAX_PREPARED_TILES:
+            return
+        tiles = [(ti, tj)
+                 for ti in range(ti0, ti1)
+                 for tj in range(tj0, tj1)]
+
+        self.tile_graph_task = TileGraphTask(tile_graph, tiles)
+        QgsApplication.taskManager().addTask(
+            self.tile_graph_task,
+            )
 
     def get_current_vector_layer(self):
         try:
             vlayer = self.iface.layerTreeView().selectedLayers()[0]
             if isinstance(vlayer, QgsVectorLayer):
                 if vlayer.wkbType() == QgsWkbTypes.MultiLineString:
-                    # if self.last_vlayer:
-                    #     if vlayer != self.last_vlayer:
-                    #         self.create_spatial_index_for_vlayer(vlayer)
-                    # else:
-                    #     self.create_spatial_index_for_vlayer(vlayer)
-                    # self.last_vlayer = vlayer
                     return vlayer
                 else:
                     self.display_message(
@@ -230,8 +408,15 @@ class PointTool(QgsMapToolEdit):
             return None
 
     def raster_layer_has_changed(self, raster_layer):
-        self.rlayer = raster_layer
-        if self.rlayer is None:
+        if self.raster_load_task is not None:
+            try:
+                self.raster_load_task.cancel()
+            except RuntimeError:
+                pass
+            self.raster_load_task = None
+
+        if raster_layer is None:
+            self.rlayer = None
             self.display_message(
                 "Missing Layer",
                 "Please select raster layer to trace",
@@ -240,37 +425,176 @@ class PointTool(QgsMapToolEdit):
                 )
             return
 
-        try:
-            sample, to_indexes, to_coords, to_coords_provider, \
-                to_coords_provider2 = \
-                get_whole_raster(self.rlayer,
-                                 QgsProject.instance(),
-                                 )
-        except PossiblyIndexedImageError:
-            self.display_message(
-                "Missing Layer",
-                "Can't trace indexed or gray image",
-                level='Critical',
-                duration=2,
+        state = self.raster_states.get(raster_layer.id())
+        if state is not None and state.crs == QgsProject.instance().crs():
+            self.use_raster_state(state)
+            return
+
+        transforms = get_transforms(raster_layer, QgsProject.instance())
+        self.raster_load_task = RasterLoadTask(raster_layer,
+                                               transforms,
+                                               self.block_cache,
+                                               self.raster_loaded,
+                                               self.disk_cache,
+                                               )
+        QgsApplication.taskManager().addTask(
+            self.raster_load_task,
+            )
+
+    def raster_loaded(self, task, result):
+        '''
+        Callback of RasterLoadTask. Replaces the raster and everything
+        computed for the previous one at once.
+        '''
+
+        if task is not self.raster_load_task:
+            # the task was replaced by the newer one
+            return
+        self.raster_load_task = None
+
+        if result is False:
+            if task.is_unsupported:
+                self.display_message(
+                    "Missing Layer",
+                    "Can't trace this raster image",
+                    level='Critical',
+                    duration=2,
+                    )
+            return
+
+        state = RasterState(task.layer,
+                            task.bands,
+                            task.transforms,
+                            QgsProject.instance().crs(),
+                            )
+        self.raster_states.put(task.layer.id(), state)
+        self.watch_raster_layer(task.layer)
+        self.use_raster_state(state)
+
+        if self.quantize_colors is not None and \
+                not isinstance(state.bands[0], LookupBand):
+            self.quantize_raster(state)
+
+        if self.disk_cache is not None and not task.from_disk_cache:
+            self.disk_cache_task = DiskCacheTask(self.disk_cache,
+                                                 task.raster_path)
+            QgsApplication.taskManager().addTask(
+                self.disk_cache_task,
                 )
+
+    def quantize_raster(self, state):
+        '''
+        Reduces colors of the raster on the background.
+        '''
+
+        if self.quantization_task is not None:
+            try:
+                self.quantization_task.cancel()
+            except RuntimeError:
+                pass
+        self.quantization_task = QuantizationTask(state,
+                                                  self.block_cache,
+                                                  self.quantize_colors,
+                                                  self.raster_quantized,
+                                                  )
+        QgsApplication.taskManager().addTask(
+            self.quantization_task,
+            )
+
+    def raster_quantized(self, task, result):
+        '''
+        Callback of QuantizationTask. Replaces the bands of the raster
+        by the quantized ones and reports the quantization error.
+        '''
+
+        if task is not self.quantization_task:
+            return
+        self.quantization_task = None
+        if result is False:
             return
 
-        r = sample[0].astype(float)
-        g = sample[1].astype(float)
-        b = sample[2].astype(float)
-        where_are_NaNs = np.isnan(r)
-        r[where_are_NaNs] = 0
-        where_are_NaNs = np.isnan(g)
-        g[where_are_NaNs] = 0
-        where_are_NaNs = np.isnan(b)
-        b[where_are_NaNs] = 0
-
-        self.sample = (r, g, b)
-        self.grid = r + g + b
-        self.to_indexes = to_indexes
-        self.to_coords = to_coords
-        self.to_coords_provider = to_coords_provider
-        self.to_coords_provider2 = to_coords_provider2
+        task.state.replace_bands(task.bands)
+        if self.rlayer is task.state.layer:
+            self.use_raster_state(task.state)
+
+        self.display_message(
+            " ",
+            "Raster is reduced to {} colors,".format(self.quantize_colors) +
+            " mean color error is {:.1f}".format(task.error),
+            level='Info',
+            duration=2,
+            )
+
+    def use_raster_state(self, state):
+        '''
+        Replaces the raster and everything computed
+        for the previous one at once.
+        '''
+
+        if self.cost_grid_cache is not None:
+            self.cost_grid_cache.log_stats()
+        self.rlayer = state.layer
+        self.sample = state.bands
+        self.cost_grid_cache = state.cost_grid_cache
+        self.drop_tile_graph()
+        self.to_indexes, self.to_coords, self.to_coords_provider, \
+            self.to_coords_provider2, self.to_coords_provider_array = \
+            state.transforms
+        self.trace_color_changed(self.trace_color)
+
+    def watch_raster_layer(self, layer):
+        '''
+        Drops the cached state of the layer when its data is changed
+        or the layer is removed.
+        '''
+
+        layer_id = layer.id()
+        if layer_id in self.watched_layers:
+            return
+        self.watched_layers.add(layer_id)
+        layer.dataChanged.connect(
+            lambda: self.raster_layer_data_changed(layer_id))
+        layer.willBeDeleted.connect(
+            lambda: self.raster_layer_deleted(layer_id))
+
+    def raster_layer_data_changed(self, layer_id):
+        self.raster_states.drop(layer_id)
+        if self.rlayer is not None and self.rlayer.id() == layer_id:
+            self.raster_layer_has_changed(self.rlayer)
+
+    def raster_layer_deleted(self, layer_id):
+        self.raster_states.drop(layer_id)
+        self.watched_layers.discard(layer_id)
+
+    def watch_vector_layer(self, vlayer):
+        '''
+        Drops the cached geometry of the traced line when its feature
+        is changed or deleted not by the tool, e.g. by undo
+        or by the vertex tool.
+        '''
+
+        layer_id = vlayer.id()
+        if layer_id in self.watched_vector_layers:
+            return
+        self.watched_vector_layers.add(layer_id)
+        vlayer.geometryChanged.connect(
+            lambda fid, _: self.traced_feature_changed(layer_id, fid))
+        vlayer.featureDeleted.connect(
+            lambda fid: self.traced_feature_deleted(layer_id, fid))
+        vlayer.willBeDeleted.connect(
+            lambda: self.watched_vector_layers.discard(layer_id))
+
+    def traced_feature_changed(self, layer_id, fid):
+        if self.changing_traced_line or self.traced_line is None:
+            return
+        if self.traced_line[:2] == (layer_id, fid):
+            self.traced_line = layer_id, fid, None
+
+    def traced_feature_deleted(self, layer_id, fid):
+        if self.traced_line is None:
+            return
+        if self.traced_line[:2] == (layer_id, fid):
+            self.traced_line = None
 
     def remove_last_anchor_point(self, undo_edit=True, redraw=True):
         '''
@@ -281,7 +605,7 @@ class PointTool(QgsMapToolEdit):
         vlayer = self.get_current_vector_layer()
         if vlayer is None:
             return
-        if vlayer.featureCount() < 1:
+        if vlayer.featureCount() < 1 and not self.line_segments:
             return
 
         # remove last marker
@@ -293,7 +617,11 @@ class PointTool(QgsMapToolEdit):
         if self.anchors:
             self.anchors.pop()
 
-        if undo_edit:
+        if undo_edit and self.buffered:
+            if self.line_segments:
+                self.line_segments.pop()
+                self.update_line_band(vlayer)
+        elif undo_edit:
             # it's a very ugly way of triggering single undo event
             self.iface.editMenu().actions()[0].trigger()
 
@@ -343,39 +671,87 @@ class PointTool(QgsMapToolEdit):
         r, g, b, = self.sample
 
         try:
-            r0 = r[i1, j1]
-            g0 = g[i1, j1]
-            b0 = b[i1, j1]
+            r0 = widen(r, (i1, j1))
+            g0 = widen(g, (i1, j1))
+            b0 = widen(b, (i1, j1))
         except IndexError:
             raise OutsideMapError
 
         if self.grid_changed is None:
-            grid = np.abs((r0 - r) ** 2 + (g0 - g) ** 2 + (b0 - b) ** 2)
+            grid = self.cost_grid_cache.get((r0, g0, b0),
+                                            self.grid_conversion,
+                                            )
         else:
             grid = self.grid_changed
 
+        # long paths are found coarse to fine if it is turned on,
+        # otherwise they are routed over the tiles
+        if self.coarse_factor is None and \
+                abs(i1 - i0) + abs(j1 - j0) >= HIERARCHICAL_MIN_DISTANCE:
+            tile_graph = self.get_tile_graph(grid)
+        else:
+            tile_graph = None
+
         if do_it_as_task:
             # dirty hack to avoid QGIS crashing
             self.find_path_task = FindPathTask(
-                grid.astype(np.dtype('l')),
+                grid,
                 start,
                 goal,
                 self.draw_path,
                 vlayer,
+                window_margin=self.search_window_margin,
+                heuristic=self.heuristic,
+                epsilon=self.epsilon,
+                bidirectional=self.bidirectional,
+                tile_graph=tile_graph,
+                coarse_factor=self.coarse_factor,
                 )
 
             QgsApplication.taskManager().addTask(
                 self.find_path_task,
                 )
             self.tracking_is_active = True
+        elif tile_graph is not None:
+            return tile_graph.find_path((i0, j0), (i1, j1))
         else:
             path, cost = FindPathFunction(
-                grid.astype(np.dtype('l')),
+                grid,
                 (i0, j0),
                 (i1, j1),
+                window_margin=self.search_window_margin,
+                heuristic=self.heuristic,
+                epsilon=self.epsilon,
+                bidirectional=self.bidirectional,
                 )
             return path, cost
 
+    def trace_over_image_to_points(self, start, goals):
+        '''
+        Performs tracing from start to each of goals with a single
+        search along the color under the start point.
+        Returns list of (path, cost) in the order of goals.
+        '''
+
+        i0, j0 = start
+        size_i, size_j = self.sample[0].shape
+        for i, j in [start] + list(goals):
+            if not (0 <= i < size_i and 0 <= j < size_j):
+                raise OutsideMapError
+
+        if self.grid_changed is None:
+            color = tuple(widen(band, (i0, j0)) for band in self.sample)
+            grid = self.cost_grid_cache.get(color, self.grid_conversion)
+        else:
+            grid = self.grid_changed
+
+        return FindPathsFunction(
+            grid,
+            start,
+            goals,
+            window_margin=self.search_window_margin,
+            )
+
     def trace(self, x1, y1, i1, j1, vlayer):
         '''
         Traces path from last point to given point.
@@ -414,15 +790,33 @@ class PointTool(QgsMapToolEdit):
         finds a nearest segment line to the current vlayer
         '''
 
-        pt = QgsPointXY(x, y)
-        # nearest_feature_id = self.spIndex.nearestNeighbor(pt, 1, tolerance)[0]
         vlayer = self.get_current_vector_layer()
-        # feature = vlayer.getFeature(nearest_feature_id)
-        for feature in vlayer.getFeatures():
-            closest_point, _, _, _, sq_distance = feature.geometry().closestVertex(pt)
-            if sq_distance < sq_tolerance:
-                return closest_point.x(), closest_point.y()
-        return x, y
+        if vlayer is None:
+            return x, y
+        closest = self.get_line_index(vlayer).closest_vertex(x, y,
+                                                             sq_tolerance)
+        if closest is None:
+            return x, y
+        return closest
+
+    def get_line_index(self, vlayer):
+        '''
+        Returns LineIndex of the vector layer,
+        building it when the layer is changed.
+        '''
+
+        if self.line_index is None or self.line_index.vlayer is not vlayer:
+            if self.line_index is not None:
+                self.line_index.close()
+            self.line_index = LineIndex(vlayer)
+            vlayer.willBeDeleted.connect(
+                lambda: self.line_index_layer_deleted(vlayer))
+        return self.line_index
+
+    def line_index_layer_deleted(self, vlayer):
+        if self.line_index is not None and self.line_index.vlayer is vlayer:
+            self.line_index.close()
+            self.line_index = None
 
     def snap(self, i, j):
         if self.snap_tolerance is None:
@@ -432,7 +826,7 @@ class PointTool(QgsMapToolEdit):
         if self.grid_changed is None:
             return i, j
 
-        size_i, size_j = self.grid.shape
+        size_i, size_j = self.sample[0].shape
         size = self.snap_tolerance
 
         if i < size or j < size or i + size > size_i or j + size > size_j:
@@ -493,47 +887,129 @@ class PointTool(QgsMapToolEdit):
 
         return
 
+    def get_vector_transform(self, vlayer):
+        '''
+        Returns transform from the CRS of the raster to the CRS of the
+        vector layer. It's created again only if any of them changed.
+        '''
+
+        source_crs = self.rlayer.dataProvider().crs()
+        destination_crs = vlayer.crs()
+        transform = self.vector_transform
+        if transform is None or \
+                transform.sourceCrs() != source_crs or \
+                transform.destinationCrs() != destination_crs:
+            transform = QgsCoordinateTransform(source_crs,
+                                               destination_crs,
+                                               QgsProject.instance())
+            self.vector_transform = transform
+        return transform
+
     def draw_path(self, path, vlayer, was_tracing=True,\
                   x1=None, y1=None):
         '''
         Draws a path after tracer found it.
         '''
 
-        transform = QgsCoordinateTransform(QgsProject.instance().crs(),
-                                           vlayer.crs(),
-                                           QgsProject.instance())
+        transform = self.get_vector_transform(vlayer)
         if was_tracing:
             if self.smooth_line:
                 path = smooth(path, size=5)
                 path = simplify(path)
             vlayer = self.get_current_vector_layer()
             current_last_point = self.to_coords(*path[-1])
-            path_ref = [transform.transform(*self.to_coords_provider(i, j)) for i, j in path]
+            ii, jj = np.array(path, dtype=float).T
+            xx, yy = transform_coords(transform,
+                                      *self.to_coords_provider_array(ii, jj))
+            path_ref = np.column_stack([xx, yy])
             x0, y0, _, _ = self.anchors[-2]
             last_point = transform.transform(*self.to_coords_provider2(x0, y0))
-            path_ref = [last_point] + path_ref[1:]
+            path_ref[0] = last_point.x(), last_point.y()
         else:
             x0, y0, _i, _j = self.anchors[-2]
             current_last_point = (x1, y1)
-            path_ref = [transform.transform(*self.to_coords_provider2(x0, y0)),
-                        transform.transform(*self.to_coords_provider2(x1, y1))]
+            path_ref = np.array([
+                [point.x(), point.y()] for point in (
+                    transform.transform(*self.to_coords_provider2(x0, y0)),
+                    transform.transform(*self.to_coords_provider2(x1, y1)))])
 
 
         self.ready = False
-        if len(self.anchors) == 2:
-            vlayer.beginEditCommand("Adding new line")
-            add_feature_to_vlayer(vlayer, path_ref)
-            vlayer.endEditCommand()
-        else:
-            vlayer.beginEditCommand("Adding new segment to the line")
-            add_to_last_feature(vlayer, path_ref)
-            vlayer.endEditCommand()
+        if self.buffered:
+            self.line_segments.append(path_ref)
+            self.update_line_band(vlayer)
+            _, _, current_last_point_i, current_last_point_j = self.anchors[-1]
+            self.anchors[-1] = current_last_point[0], current_last_point[1], current_last_point_i, current_last_point_j
+            self.tracking_is_active = False
+            return
+
+        self.watch_vector_layer(vlayer)
+        # the signals of this change must not drop the cached geometry
+        self.changing_traced_line = True
+        try:
+            if len(self.anchors) == 2:
+                vlayer.beginEditCommand("Adding new line")
+                fid, geom = add_feature_to_vlayer(vlayer, path_ref)
+                vlayer.endEditCommand()
+            else:
+                fid, geom = None, None
+                if self.traced_line is not None and \
+                        self.traced_line[0] == vlayer.id():
+                    _, fid, geom = self.traced_line
+                vlayer.beginEditCommand("Adding new segment to the line")
+                fid, geom = add_to_last_feature(vlayer, path_ref, fid, geom)
+                vlayer.endEditCommand()
+        finally:
+            self.changing_traced_line = False
+        self.traced_line = vlayer.id(), fid, geom
         _, _, current_last_point_i, current_last_point_j = self.anchors[-1]
         self.anchors[-1] = current_last_point[0], current_last_point[1], current_last_point_i, current_last_point_j
         self.redraw()
         self.tracking_is_active = False
 
 
+    def get_buffered_points(self):
+        '''
+        Returns points of all segments of the buffered line
+        without repeating the points where the segments meet.
+        '''
+
+        if not self.line_segments:
+            return np.empty((0, 2))
+        return np.concatenate([self.line_segments[0]] +
+                              [segment[1:]
+                               for segment in self.line_segments[1:]])
+
+    def update_line_band(self, vlayer):
+        '''
+        Shows the buffered line by the rubber band.
+        '''
+
+        points = self.get_buffered_points()
+        if len(points) < 2:
+            self.line_band.reset(QgsWkbTypes.LineGeometry)
+            return
+        geom = QgsGeometry()
+        geom.fromWkb(get_line_wkb(points))
+        self.line_band.setToGeometry(geom, vlayer)
+
+    def finish_line(self, vlayer):
+        '''
+        Writes the buffered line to the vector layer as a single
+        feature with a single edit command.
+        '''
+
+        points = self.get_buffered_points()
+        self.line_segments = []
+        self.line_band.reset(QgsWkbTypes.LineGeometry)
+        if len(points) < 2 or vlayer is None:
+            return
+
+        vlayer.beginEditCommand("Adding new line")
+        add_feature_to_vlayer(vlayer, points)
+        vlayer.endEditCommand()
+        self.redraw()
+
     def update_rubber_band(self):
         # this is very ugly but I can't make another way
         if self.last_mouse_event_pos is None:
@@ -566,15 +1042,32 @@ class PointTool(QgsMapToolEdit):
     def canvasMoveEvent(self, mouseEvent):
         '''
         Store the mouse position for the correct
-        updating of the rubber band
+        updating of the rubber band. The position is processed
+        by the timer, so only the last of frequent moves is used.
         '''
 
         # we need at least one point to draw
         if not self.anchors:
             return
 
+        self.pending_mouse_pos = mouseEvent.pos()
+        if not self.mouse_move_timer.isActive():
+            self.mouse_move_timer.start()
+
+    def process_mouse_move(self):
+        '''
+        Moves the snap marker and the rubber band to the last mouse
+        position. Only these canvas items are updated, the layers are
+        repainted only when the traced line is changed.
+        '''
+
+        pos = self.pending_mouse_pos
+        self.pending_mouse_pos = None
+        if pos is None or not self.anchors:
+            return
+
         if self.snap_tolerance is not None and self.tracing_mode.is_tracing():
-            qgsPoint = self.toMapCoordinates(mouseEvent.pos())
+            qgsPoint = self.toMapCoordinates(pos)
             x1, y1 = qgsPoint.x(), qgsPoint.y()
             # i, j = get_indxs_from_raster_coords(self.geo_ref, x1, y1)
             i, j = self.to_indexes(x1, y1)
@@ -586,9 +1079,8 @@ class PointTool(QgsMapToolEdit):
             x1, y1 = self.to_coords(i1, j1)
             self.marker_snap.setCenter(QgsPointXY(x1, y1))
 
-        self.last_mouse_event_pos = mouseEvent.pos()
+        self.last_mouse_event_pos = pos
         self.update_rubber_band()
-        self.redraw()
 
     def abort_tracing_process(self):
         '''
@@ -641,47 +1133,72 @@ class PointTool(QgsMapToolEdit):
         newRect = QgsRectangle(xMin, yMin, xMax, yMax)
         self.iface.mapCanvas().setExtent(newRect)
 
-    def add_last_feature_to_spindex(self, vlayer):
-        '''
-        Adds last feature to spatial index
-        '''
-        features = list(vlayer.getFeatures())
-        last_feature = features[-1]
-        self.spIndex.insertFeature(last_feature)
-
-    def create_spatial_index_for_vlayer(self, vlayer):
-        '''
-        Creates spatial index for the vlayer
-        '''
 
-        self.spIndex = QgsSpatialIndex()
-        # features = [f for f in vlayer]
-        self.spIndex.addFeatures(vlayer.getFeatures())
 
-
-
-def add_to_last_feature(vlayer, points):
+def add_to_last_feature(vlayer, points, fid=None, geom=None):
     '''
-    Adds points to the last line feature in the vlayer
+    Adds points to the line feature with the given id in the vlayer,
+    or to the last line feature if the id is unknown or outdated,
+    e.g. after the edits were saved.
     vlayer - QgsLayer of type MultiLine string
-    points - list of points
+    points - array-like (n, 2) of points
+    fid - id of the feature
+    geom - current geometry of the feature, read from the layer if None
+    Returns (fid, geom) of the changed feature.
     '''
+
+    if fid is not None:
+        if geom is None:
+            geom = vlayer.getFeature(fid).geometry()
+        if not geom.isEmpty():
+            geom = add_points_to_geometry(geom, points)
+            if vlayer.changeGeometry(fid, geom):
+                return fid, geom
+
     features = list(vlayer.getFeatures())
     last_feature = features[-1]
     fid = last_feature.id()
-    geom = last_feature.geometry()
-    points = [QgsPointXY(x, y) for x, y in points]
-    geom.addPointsXY(points)
+    geom = add_points_to_geometry(last_feature.geometry(), points)
     vlayer.changeGeometry(fid, geom)
+    return fid, geom
+
+
+def add_points_to_geometry(geom, points):
+    '''
+    Returns the line geometry with the points appended to its last
+    line. The first point is the last point of the line already,
+    so it is skipped. The points are appended to WKB of the geometry
+    if possible, without creating a point object per point, and
+    vertex by vertex otherwise, e.g. for the lines with Z values.
+    '''
+
+    points = points[1:]
+    wkb = append_to_line_wkb(bytes(geom.asWkb()), points)
+    if wkb is None:
+        geom = QgsGeometry(geom)
+        line = geom.get()
+        if geom.isMultipart():
+            line = line.geometryN(line.numGeometries() - 1)
+        for x, y in points:
+            line.addVertex(QgsPoint(x, y))
+        return geom
+    geom = QgsGeometry()
+    geom.fromWkb(wkb)
+    return geom
 
 
 def add_feature_to_vlayer(vlayer, points):
     '''
     Adds new line feature to the vlayer
+    Returns (fid, None) of the added feature.
     '''
 
     feat = QgsFeature(vlayer.fields())
-    polyline = [QgsPoint(x, y) for x, y in points]
-    feat.setGeometry(QgsGeometry.fromPolyline(polyline))
+    geom = QgsGeometry()
+    geom.fromWkb(get_line_wkb(points))
+    feat.setGeometry(geom)
     vlayer.addFeature(feat)
+    # the geometry is read back on the next segment,
+    # since the layer may store it converted to multi line
+    return feat.id(), None
 
@@ -56,6 +56,16 @@ class State:
                 )
             return False
 
+        # check if the raster is still being opened
+        if self.pointtool.raster_load_task is not None:
+            self.pointtool.display_message(
+                " ",
+                "Please wait till the raster layer is loaded",
+                level='Info',
+                duration=1,
+                )
+            return False
+
         # acquire point coordinates from mouseEvent
         qgsPoint = self.pointtool.toMapCoordinates(mouseEvent.pos())
         x1, y1 = qgsPoint.x(), qgsPoint.y()
@@ -133,10 +143,10 @@ class WaitingMiddlePointState(State):
 
     def click_rmb(self, mouseEvent, vlayer):
 
-        super().click_rmb(mouseEvent, vlayer)
+        # write the line if it was buffered
+        self.pointtool.finish_line(vlayer)
 
-        # # add last feature to spatial index to perform fast search of closet points
-        # self.pointtool.add_last_feature_to_spindex(vlayer)
+        super().click_rmb(mouseEvent, vlayer)
 
 
 class AutoFollowingLineState(State):
@@ -162,6 +172,7 @@ class AutoFollowingLineState(State):
          
 
     def click_rmb(self, mouseEvent, vlayer):
+        self.pointtool.finish_line(vlayer)
         super().click_rmb(mouseEvent, vlayer)
 
     def follow_next_segment(self, vlayer, initial=False):
@@ -177,16 +188,9 @@ class AutoFollowingLineState(State):
 
         points = self.search_near_points((i1, j1), direction, distance)
 
-        costs = []
-        paths = []
-
-        for point in points:
-            i2, j2 = point
-            x2, y2 = self.pointtool.to_coords(i2, j2)
-
-            path, cost = self.pointtool.trace_over_image((i1, j1), (i2, j2))
-            costs.append(cost)
-            paths.append(path)
+        results = self.pointtool.trace_over_image_to_points((i1, j1), points)
+        paths = [path for path, _ in results]
+        costs = [cost for _, cost in results]
 
         min_cost = min(costs)
         min_cost_index = costs.index(min_cost)
@@ -0,0 +1,232 @@
+'''
+Module reduces colors of RGB rasters to a small palette found
+by k-means method on a sample of the pixels. Pixels are replaced
+by the indexes of the nearest colors of the palette, so the costs
+of the cost grid are computed once per color of the palette and
+gathered by the indexes, the same way as for paletted rasters.
+'''
+
+import numpy as np
+
+from qgis.core import QgsTask
+
+from .utils import read_tiled, widen, LookupBand, BAND_TOKENS
+
+# number of colors of the palette
+QUANTIZATION_COLORS = 64
+
+# how many pixels the palette is fitted on
+QUANTIZATION_SAMPLE_SIZE = 65536
+
+# number of iterations of k-means
+QUANTIZATION_ITERATIONS = 10
+
+# size of the square windows the sampled pixels are read from,
+# they are taken from the grid of this size spread over the raster
+SAMPLE_WINDOW = 128
+SAMPLE_WINDOWS_GRID = 8
+
+# size of the square blocks the indexes are computed in
+QUANTIZATION_BLOCK = 256
+
+
+def sample_colors(sample, size=QUANTIZATION_SAMPLE_SIZE, seed=0):
+    '''
+    Returns array (n, 3) of colors of at most size pixels taken at
+    random from the windows spread evenly over the raster.
+    The colors keep the range of the data type of the bands.
+    '''
+
+    size_i, size_j = sample[0].shape
+    grid = SAMPLE_WINDOWS_GRID
+    window = SAMPLE_WINDOW
+
+    colors = []
+    for i in np.linspace(0, max(size_i - window, 0), grid).astype(int):
+        for j in np.linspace(0, max(size_j - window, 0), grid).astype(int):
+            key = slice(i, i + window), slice(j, j + window)
+            colors.append(np.stack([widen(band, key).ravel()
+                                    for band in sample], axis=1))
+    colors = np.concatenate(colors)
+
+    # pixels of the same color are sampled in proportion to their count,
+    # 8-bit colors are packed into single numbers for the faster unique,
+    # colors of other types are kept as they are, without clipping
+    if all(np.dtype(getattr(band, 'dtype', float)) == np.uint8
+           for band in sample):
+        colors = colors.astype(np.int64)
+        packed, counts = np.unique((colors[:, 0] << 16)
+                                   | (colors[:, 1] << 8) | colors[:, 2],
+                                   return_counts=True)
+        colors = np.stack([packed >> 16, (packed >> 8) & 255, packed & 255],
+                          axis=1).astype(float)
+    else:
+        colors, counts = np.unique(colors, axis=0, return_counts=True)
+    rng = np.random.default_rng(seed)
+    if counts.sum() > size:
+        picked = rng.choice(len(colors), size, p=counts / counts.sum())
+        return colors[picked]
+    return np.repeat(colors, counts, axis=0)
+
+
+def nearest(colors, palette):
+    '''
+    Returns indexes of the nearest colors of the palette
+    and squared distances to them.
+    '''
+
+    # float32 is precise enough for the distances between 8-bit colors,
+    # the colors of wider types need float64
+    dtype = np.float32 if np.abs(palette).max() <= 255 else np.float64
+    colors = colors.astype(dtype)
+    palette = palette.astype(dtype)
+    distances = (colors ** 2).sum(axis=1)[:, None] \
+        - 2 * colors @ palette.T + (palette ** 2).sum(axis=1)[None, :]
+    indexes = distances.argmin(axis=1)
+    closest = distances[np.arange(len(colors)), indexes]
+    return indexes, np.maximum(closest, 0)
+
+
+def fit_palette(colors, count=QUANTIZATION_COLORS,
+                iterations=QUANTIZATION_ITERATIONS, seed=0,
+                is_canceled=None):
+    '''
+    Returns palette (count, 3) found by k-means on colors, or all
+    different colors if there are not more of them than count.
+    The palette starts from different colors, so the rare colors
+    of thin lines have the same chance as the colors of large areas.
+    Returns None if it was canceled.
+    '''
+
+    unique = np.unique(colors, axis=0)
+    if len(unique) <= count:
+        return unique
+
+    rng = np.random.default_rng(seed)
+    palette = unique[rng.choice(len(unique), count, replace=False)]
+    for _ in range(iterations):
+        if is_canceled is not None and is_canceled():
+            return None
+        indexes, _ = nearest(colors, palette)
+        counts = np.bincount(indexes, minlength=count)
+        filled = counts > 0
+        for k in range(3):
+            sums = np.bincount(indexes, weights=colors[:, k],
+                               minlength=count)
+            palette[filled, k] = sums[filled] / counts[filled]
+    return palette
+
+
+class QuantizedBand:
+    '''
+    2D array-like band of the indexes of the nearest colors of the
+    palette to the pixels of RGB sample. Indexes are computed by
+    blocks when they are accessed first time and kept in BlockCache.
+    '''
+
+    def __init__(self, sample, palette, cache):
+        self.sample = sample
+        self.palette = palette
+        self.cache = cache
+        self.token = next(BAND_TOKENS)
+        self.shape = sample[0].shape
+        self.block_shape = QUANTIZATION_BLOCK, QUANTIZATION_BLOCK
+        self.dtype = np.dtype(np.uint8 if len(palette) <= 256
+                              else np.uint16)
+        self.nodata = None
+
+    def read_block(self, bi, bj):
+        block_i, block_j = self.block_shape
+        key = (slice(bi * block_i, (bi + 1) * block_i),
+               slice(bj * block_j, (bj + 1) * block_j))
+        colors = [widen(band, key) for band in self.sample]
+        shape = colors[0].shape
+        colors = np.stack([c.ravel() for c in colors], axis=1)
+        indexes, _ = nearest(colors, self.palette)
+        return indexes.astype(self.dtype).reshape(shape)
+
+    def get_block(self, bi, bj):
+        return self.cache.get((self.token, bi, bj),
+                              lambda: self.read_block(bi, bj))
+
+    def drop_blocks(self):
+        self.cache.drop(self.token)
+
+    def __getitem__(self, key):
+        return read_tiled(self.shape, self.block_shape, key,
+                          self.get_block, self.dtype)
+
+
+def quantize(sample, cache, count=QUANTIZATION_COLORS, is_canceled=None):
+    '''
+    Returns (bands, error), where bands is tuple (r, g, b) of
+    LookupBands with the colors of the palette fitted to the sample
+    over QuantizedBand, and error is root mean square distance
+    between the colors of the sampled pixels and their palette colors.
+    Returns None if it was canceled.
+    '''
+
+    colors = sample_colors(sample)
+    palette = fit_palette(colors, count, is_canceled=is_canceled)
+    if palette is None:
+        return None
+
+    _, distances = nearest(colors, palette)
+    error = float(np.sqrt(distances.mean()))
+
+    band = QuantizedBand(sample, palette, cache)
+    tables = palette.T.astype(np.float32)
+    return tuple(LookupBand(band, table) for table in tables), error
+
+
+class QuantizationTask(QgsTask):
+    '''
+    Implementation of QGIS QgsTask
+    for quantizing colors of the raster on the background.
+    '''
+
+    def __init__(self, state, cache, count, callback):
+        '''
+        Receives: state - RasterState of the raster to quantize
+        cache - BlockCache for the indexes
+        count - number of colors of the palette
+        callback - function to call with the task and its result
+        '''
+
+        super().__init__(
+            'Task for quantizing raster for raster_tracer',
+            QgsTask.CanCancel
+                )
+        self.state = state
+        self.cache = cache
+        self.count = count
+        self.callback = callback
+        self.bands = None
+        self.error = None
+
+    def run(self):
+        '''
+        Fits the palette to the raster.
+        '''
+
+        result = quantize(self.state.bands, self.cache, self.count,
+                          is_canceled=self.isCanceled)
+        if result is None:
+            return False
+        self.bands, self.error = result
+        return True
+
+    def finished(self, result):
+        '''
+        Call callback function with the result of self.run
+        '''
+
+        self.callback(self, result)
+
+    def cancel(self):
+        '''
+        Executed when run catches cancel signal.
+        Terminates the QgsTask.
+        '''
+
+        super().cancel()
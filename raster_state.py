@@ -0,0 +1,130 @@
+'''
+Module contains cache of everything prepared for tracing over
+the raster layers, so switching back to the layer doesn't open
+the raster again.
+'''
+
+from collections import OrderedDict
+
+from .cost_grid import CostGridCache
+from .quantization import QuantizedBand
+from .utils import LookupBand
+
+# how many bytes of cost grids of all cached layers RasterStateCache
+# may keep
+RASTER_STATE_CACHE_BUDGET = 512 * 1024 ** 2
+
+
+def get_cached_bands(bands):
+    '''
+    Returns set of the bands that keep their blocks in BlockCache
+    among the given bands and the bands they are built over.
+    '''
+
+    cached = set()
+    stack = list(bands)
+    while stack:
+        band = stack.pop()
+        if hasattr(band, 'drop_blocks'):
+            cached.add(band)
+        if isinstance(band, LookupBand):
+            stack.append(band.band)
+        elif isinstance(band, QuantizedBand):
+            stack.extend(band.sample)
+    return cached
+
+
+class RasterState:
+    '''
+    Prepared raster layer: its bands, functions converting the
+    coordinates and cost grids computed for it.
+    '''
+
+    def __init__(self, layer, bands, transforms, crs):
+        '''
+        layer - QgsRasterLayer
+        bands - tuple (r, g, b) of 2D array-like bands of the raster
+        transforms - functions returned by get_transforms for the layer
+        crs - CRS of the project the transforms were created for
+        '''
+
+        self.layer = layer
+        self.bands = bands
+        self.transforms = transforms
+        self.crs = crs
+        self.cost_grid_cache = CostGridCache(bands)
+
+    def replace_bands(self, bands):
+        '''
+        Replaces the bands, e.g. by the quantized ones, and drops
+        the cost grids and the blocks of the bands not used any more.
+        '''
+
+        old_bands = get_cached_bands(self.bands)
+        self.bands = bands
+        self.cost_grid_cache = CostGridCache(bands)
+        for band in old_bands - get_cached_bands(bands):
+            band.drop_blocks()
+
+    def release(self):
+        '''
+        Drops the blocks of the bands from BlockCache
+        once the state is not used any more.
+        '''
+
+        for band in get_cached_bands(self.bands):
+            band.drop_blocks()
+
+    @property
+    def nbytes(self):
+        return self.cost_grid_cache.nbytes
+
+
+class RasterStateCache:
+    '''
+    Least recently used cache of RasterStates keyed by the id of the
+    layer. The least recently used states are dropped while their cost
+    grids take more than the budget. Blocks of the rasters are kept
+    in the shared BlockCache and are not counted here.
+    '''
+
+    def __init__(self, budget=RASTER_STATE_CACHE_BUDGET):
+        self.budget = budget
+        self.states = OrderedDict()
+
+    def get(self, layer_id):
+        '''
+        Returns RasterState of the layer or None if it's not cached.
+        '''
+
+        state = self.states.get(layer_id)
+        if state is not None:
+            self.states.move_to_end(layer_id)
+        return state
+
+    def put(self, layer_id, state):
+        old_state = self.states.get(layer_id)
+        if old_state is not None and old_state is not state:
+            old_state.release()
+        self.states[layer_id] = state
+        self.states.move_to_end(layer_id)
+        self.evict()
+
+    def drop(self, layer_id):
+        state = self.states.pop(layer_id, None)
+        if state is not None:
+            state.release()
+
+    @property
+    def nbytes(self):
+        return sum(state.nbytes for state in self.states.values())
+
+    def evict(self):
+        '''
+        Drops least recently used states until the cache fits
+        the budget. The most recent state is always kept.
+        '''
+
+        while len(self.states) > 1 and self.nbytes > self.budget:
+            _, state = self.states.popitem(last=False)
+            state.release()
@@ -268,6 +268,20 @@ class RasterTracer:
         self.dockwidget.checkBoxSnap2.stateChanged.connect(self.checkBoxSnap2_changed)
         self.dockwidget.SpinBoxSnap.valueChanged.connect(self.checkBoxSnap2_changed)
 
+        self.dockwidget.comboBoxHeuristic.currentIndexChanged.connect(self.search_options_changed)
+        self.dockwidget.doubleSpinBoxEpsilon.valueChanged.connect(self.search_options_changed)
+        self.dockwidget.checkBoxBidirectional.stateChanged.connect(self.search_options_changed)
+        self.dockwidget.checkBoxCoarse.stateChanged.connect(self.search_options_changed)
+        self.dockwidget.SpinBoxCoarse.valueChanged.connect(self.search_options_changed)
+        self.search_options_changed()
+
+        self.dockwidget.checkBoxQuantize.stateChanged.connect(self.checkBoxQuantize_changed)
+        self.dockwidget.SpinBoxQuantize.valueChanged.connect(self.checkBoxQuantize_changed)
+
+        self.dockwidget.checkBoxBuffered.stateChanged.connect(self.checkBoxBuffered_changed)
+
+        self.dockwidget.checkBoxDiskCache.stateChanged.connect(self.checkBoxDiskCache_changed)
+
 
     def raster_layer_changed(self):
         self.tool_identify.raster_layer_has_changed(self.dockwidget.mMapLayerComboBox.currentLayer())
@@ -295,6 +309,38 @@ class RasterTracer:
             self.tool_identify.snap2_tolerance_changed(None)
 
 
+    def search_options_changed(self):
+        self.tool_identify.heuristic = self.dockwidget.comboBoxHeuristic.currentText()
+        self.tool_identify.epsilon = self.dockwidget.doubleSpinBoxEpsilon.value()
+        bidirectional = self.dockwidget.checkBoxBidirectional.isChecked()
+        self.tool_identify.bidirectional = bidirectional
+        # the heuristic is not used by the bidirectional search
+        self.dockwidget.comboBoxHeuristic.setEnabled(not bidirectional)
+        self.dockwidget.doubleSpinBoxEpsilon.setEnabled(not bidirectional)
+        if self.dockwidget.checkBoxCoarse.isChecked():
+            self.dockwidget.SpinBoxCoarse.setEnabled(True)
+            self.tool_identify.coarse_factor = self.dockwidget.SpinBoxCoarse.value()
+        else:
+            self.dockwidget.SpinBoxCoarse.setEnabled(False)
+            self.tool_identify.coarse_factor = None
+
+    def checkBoxQuantize_changed(self):
+        if self.dockwidget.checkBoxQuantize.isChecked():
+            self.dockwidget.SpinBoxQuantize.setEnabled(True)
+            count = self.dockwidget.SpinBoxQuantize.value()
+            self.tool_identify.quantize_colors_changed(count)
+        else:
+            self.dockwidget.SpinBoxQuantize.setEnabled(False)
+            self.tool_identify.quantize_colors_changed(None)
+
+    def checkBoxBuffered_changed(self):
+        self.tool_identify.buffered_changed(
+            self.dockwidget.checkBoxBuffered.isChecked())
+
+    def checkBoxDiskCache_changed(self):
+        self.tool_identify.disk_cache_changed(
+            self.dockwidget.checkBoxDiskCache.isChecked())
+
     def turn_off_snap(self):
         self.dockwidget.checkBoxSnap.nextCheckState()
 
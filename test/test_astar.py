@@ -0,0 +1,263 @@
+# coding=utf-8
+"""Tests of the searches against plain Dijkstra on small grids."""
+
+import unittest
+from heapq import heappush, heappop
+
+import numpy as np
+
+from raster_tracer.astar import SearchGrid, FindPathFunction, \
+    FindPathsFunction, get_window, CoarseGrid, coarsen, \
+    find_path_coarse_to_fine
+
+
+def dijkstra(graph, start):
+    """Returns costs of the best paths from start to all cells,
+    a step costs the cost of the cell it enters."""
+
+    size_i, size_j = graph.shape
+    costs = np.full(graph.shape, -1, dtype=np.int64)
+    frontier = [(0, start)]
+    while frontier:
+        cost, (i, j) = heappop(frontier)
+        if costs[i, j] >= 0:
+            continue
+        costs[i, j] = cost
+        for di, dj in ((-1, 0), (0, -1), (1, 0), (0, 1)):
+            ni, nj = i + di, j + dj
+            if 0 <= ni < size_i and 0 <= nj < size_j and costs[ni, nj] < 0:
+                heappush(frontier, (cost + int(graph[ni, nj]), (ni, nj)))
+    return costs
+
+
+class GridTestCase(unittest.TestCase):
+    """Random grids and checks of the paths found on them."""
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def random_graphs(self, count=40, max_size=40, low=0):
+        """Grids of random shapes with costs from low up to
+        the range of color_diff."""
+
+        for _ in range(count):
+            shape = tuple(self.rng.integers(1, max_size, 2))
+            high = int(self.rng.choice([2, 50, 200000]))
+            yield self.rng.integers(low, low + high, shape).astype(np.int64)
+
+    def random_cell(self, shape):
+        return (int(self.rng.integers(shape[0])),
+                int(self.rng.integers(shape[1])))
+
+    def assertPath(self, graph, path, cost, start, goal):
+        """The path goes from start to goal by single steps
+        and costs the sum of the cells it enters."""
+
+        self.assertEqual(path[0], start)
+        self.assertEqual(path[-1], goal)
+        for (i0, j0), (i1, j1) in zip(path, path[1:]):
+            self.assertEqual(abs(i1 - i0) + abs(j1 - j0), 1)
+        self.assertEqual(cost, sum(int(graph[cell]) for cell in path[1:]))
+
+
+class SearchTest(GridTestCase):
+    """Test A* on the flat SearchGrid."""
+
+    def test_node_ids(self):
+        grid = SearchGrid(np.zeros((3, 5), dtype=np.int64))
+        for i in range(3):
+            for j in range(5):
+                self.assertEqual(grid.ij(grid.node((i, j))), (i, j))
+        # the border of walls surrounds the grid
+        self.assertEqual(grid.cost.reshape(5, 7)[0].tolist(), [-1] * 7)
+
+    def test_optimal_on_positive_costs(self):
+        """With costs of at least one the Manhattan heuristic
+        never overestimates, so A* finds the best path."""
+
+        for graph in self.random_graphs(low=1):
+            start = self.random_cell(graph.shape)
+            goal = self.random_cell(graph.shape)
+            path, cost = FindPathFunction(graph, start, goal)
+            self.assertPath(graph, path, cost, start, goal)
+            self.assertEqual(cost, dijkstra(graph, start)[goal])
+
+    def test_zero_costs(self):
+        for graph in self.random_graphs():
+            start = self.random_cell(graph.shape)
+            goal = self.random_cell(graph.shape)
+            path, cost = FindPathFunction(graph, start, goal)
+            self.assertPath(graph, path, cost, start, goal)
+            self.assertGreaterEqual(cost, dijkstra(graph, start)[goal])
+
+    def test_start_is_goal(self):
+        graph = np.ones((4, 4), dtype=np.int64)
+        self.assertEqual(FindPathFunction(graph, (2, 1), (2, 1)),
+                         ([(2, 1)], 0))
+
+
+class WindowTest(GridTestCase):
+    """Test the search inside the window grown on demand."""
+
+    def test_get_window(self):
+        self.assertEqual(get_window((100, 50), [(10, 40), (30, 20)], 15),
+                         (0, 46, 5, 50))
+
+    def test_same_as_whole_grid(self):
+        """With costs of at least one the result doesn't depend
+        on the window, however small it starts."""
+
+        for graph in self.random_graphs(low=1):
+            start = self.random_cell(graph.shape)
+            goal = self.random_cell(graph.shape)
+            best = dijkstra(graph, start)[goal]
+            for window_margin in (0, 1, 5):
+                path, cost = FindPathFunction(graph, start, goal,
+                                              window_margin)
+                self.assertPath(graph, path, cost, start, goal)
+                self.assertEqual(cost, best)
+
+    def test_grows_around_wall(self):
+        """The only cheap way goes far outside the first window."""
+
+        graph = np.full((60, 60), 1000, dtype=np.int64)
+        graph[:, 10] = 1
+        graph[50, 10:31] = 1
+        graph[:, 30] = 1
+        start, goal = (5, 10), (5, 30)
+        path, cost = FindPathFunction(graph, start, goal, 1)
+        self.assertPath(graph, path, cost, start, goal)
+        self.assertEqual(cost, dijkstra(graph, start)[goal])
+        self.assertTrue(any(i == 50 for i, _ in path))
+
+
+class SearchManyTest(GridTestCase):
+    """Test the single search to many goals."""
+
+    def test_same_as_dijkstra(self):
+        """The search to many goals is Dijkstra, so it is exact
+        also inside the windows and with zero costs."""
+
+        for graph in self.random_graphs():
+            start = self.random_cell(graph.shape)
+            goals = [self.random_cell(graph.shape) for _ in range(4)]
+            costs = dijkstra(graph, start)
+            for window_margin in (None, 0, 3):
+                results = FindPathsFunction(graph, start, goals,
+                                            window_margin)
+                self.assertEqual(len(results), len(goals))
+                for goal, (path, cost) in zip(goals, results):
+                    self.assertPath(graph, path, cost, start, goal)
+                    self.assertEqual(cost, costs[goal])
+
+
+class HeuristicTest(GridTestCase):
+    """Test the heuristics and weighted A*."""
+
+    def test_admissible_is_optimal(self):
+        for graph in self.random_graphs():
+            start = self.random_cell(graph.shape)
+            goal = self.random_cell(graph.shape)
+            best = dijkstra(graph, start)[goal]
+            for window_margin in (None, 0, 2):
+                path, cost = FindPathFunction(graph, start, goal,
+                                              window_margin,
+                                              heuristic='admissible')
+                self.assertPath(graph, path, cost, start, goal)
+                self.assertEqual(cost, best)
+
+    def test_epsilon_bounds_the_cost(self):
+        for graph in self.random_graphs():
+            start = self.random_cell(graph.shape)
+            goal = self.random_cell(graph.shape)
+            best = dijkstra(graph, start)[goal]
+            for window_margin in (None, 2):
+                path, cost = FindPathFunction(graph, start, goal,
+                                              window_margin,
+                                              heuristic='admissible',
+                                              epsilon=0.5)
+                self.assertPath(graph, path, cost, start, goal)
+                self.assertGreaterEqual(cost, best)
+                self.assertLessEqual(cost, 1.5 * best)
+
+    def test_admissible_sees_cheap_cells_outside_window(self):
+        """The estimates inside the window don't hide the cheaper
+        path that goes around the window."""
+
+        graph = np.full((30, 30), 100, dtype=np.int64)
+        graph[5:25, 14] = 0
+        path, cost = FindPathFunction(graph, (10, 10), (20, 10), 2,
+                                      heuristic='admissible')
+        self.assertPath(graph, path, cost, (10, 10), (20, 10))
+        self.assertEqual(cost, 700)
+
+
+class BidirectionalTest(GridTestCase):
+    """Test the search from both ends at once."""
+
+    def test_same_as_dijkstra(self):
+        for graph in self.random_graphs():
+            start = self.random_cell(graph.shape)
+            goal = self.random_cell(graph.shape)
+            best = dijkstra(graph, start)[goal]
+            for window_margin in (None, 0, 2):
+                path, cost = FindPathFunction(graph, start, goal,
+                                              window_margin,
+                                              bidirectional=True)
+                self.assertPath(graph, path, cost, start, goal)
+                self.assertEqual(cost, best)
+
+    def test_window_around_wall(self):
+        graph = np.full((30, 30), 100, dtype=np.int64)
+        graph[5:25, 14] = 0
+        path, cost = FindPathFunction(graph, (10, 10), (20, 10), 2,
+                                      bidirectional=True)
+        self.assertPath(graph, path, cost, (10, 10), (20, 10))
+        self.assertEqual(cost, 700)
+
+
+class CoarseToFineTest(GridTestCase):
+    """Test the search on the coarse grid refined along its path."""
+
+    def test_coarse_grid_matches_coarsen(self):
+        graph = self.rng.integers(0, 100, (300, 170)).astype(np.int64)
+        for factor in (2, 3, 8):
+            coarse = CoarseGrid(graph, factor)
+            np.testing.assert_array_equal(coarse[:, :],
+                                          coarsen(graph, factor))
+            self.assertEqual(coarse.shape, coarsen(graph, factor).shape)
+
+    def test_follows_thin_line(self):
+        """The line one pixel wide stays cheap on the coarse grid,
+        so the path goes along it as the best path does."""
+
+        graph = np.full((200, 220), 50, dtype=np.int64)
+        graph[10, 10:151] = 0
+        graph[10:181, 150] = 0
+        graph[180, 60:151] = 0
+        start, goal = (10, 10), (180, 60)
+        for factor in (2, 4, 8):
+            path, cost = find_path_coarse_to_fine(graph, start, goal,
+                                                  factor, 4)
+            self.assertPath(graph, path, cost, start, goal)
+            self.assertEqual(cost, 0)
+
+    def test_valid_paths(self):
+        for graph in self.random_graphs(max_size=120):
+            start = self.random_cell(graph.shape)
+            goal = self.random_cell(graph.shape)
+            best = dijkstra(graph, start)[goal]
+            for factor in (2, 5, 8):
+                path, cost = find_path_coarse_to_fine(graph, start, goal,
+                                                      factor, 4)
+                self.assertPath(graph, path, cost, start, goal)
+                self.assertGreaterEqual(cost, best)
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite(unittest.makeSuite(case) for case in
+                               (SearchTest, WindowTest, SearchManyTest,
+                                HeuristicTest, BidirectionalTest,
+                                CoarseToFineTest))
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,139 @@
+# coding=utf-8
+"""Tests of the lazily computed grids of costs."""
+
+import unittest
+
+import numpy as np
+
+from raster_tracer.cost_grid import CostGrid, CostGridCache, TILE_SIZE, \
+    color_diff, gray_diff
+from raster_tracer.utils import LookupBand
+
+
+class CostGridTest(unittest.TestCase):
+    """Test computing of the costs by tiles."""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.sample = tuple(rng.integers(0, 256, (300, 520))
+                            .astype(np.uint8) for _ in range(3))
+        self.color = (10, 200, 30)
+        self.costs = color_diff(tuple(band.astype(float)
+                                      for band in self.sample),
+                                self.color).astype(np.int64)
+
+    def test_windows_match_whole_grid(self):
+        grid = CostGrid(self.sample, self.color)
+        np.testing.assert_array_equal(grid[:, :], self.costs)
+        np.testing.assert_array_equal(grid[250:290, 200:300],
+                                      self.costs[250:290, 200:300])
+        self.assertEqual(grid[299, 519], self.costs[299, 519])
+        with self.assertRaises(IndexError):
+            grid[300, 0]
+
+    def test_only_requested_tiles_are_computed(self):
+        grid = CostGrid(self.sample, self.color)
+        grid[10:20, 10:20]
+        self.assertEqual(list(grid.tiles), [(0, 0)])
+        grid[TILE_SIZE - 1:TILE_SIZE + 1, 10:20]
+        self.assertEqual(sorted(grid.tiles), [(0, 0), (1, 0)])
+
+    def test_budget(self):
+        tile_bytes = TILE_SIZE * TILE_SIZE * 8
+        grid = CostGrid(self.sample, self.color, budget=2 * tile_bytes)
+        np.testing.assert_array_equal(grid[:, :], self.costs)
+        self.assertLessEqual(grid.nbytes, 2 * tile_bytes)
+        self.assertEqual(grid.nbytes,
+                         sum(tile.nbytes for tile in grid.tiles.values()))
+
+    def test_lookup_bands_match_direct_costs(self):
+        """Costs of the paletted raster are looked up by the indexes
+        and are the same as the costs of its colors."""
+
+        rng = np.random.default_rng(1)
+        indexes = rng.integers(0, 256, (300, 520)).astype(np.uint8)
+        tables = rng.integers(0, 256, (3, 256)).astype(np.float32)
+        # nodata is black, as widen makes it
+        tables[:, 5] = np.nan
+        sample = tuple(LookupBand(indexes, table) for table in tables)
+        colors = tuple(np.nan_to_num(table)[indexes] for table in tables)
+        for mode, cost_function in (('color_diff', color_diff),
+                                    ('gray_diff', gray_diff)):
+            grid = CostGrid(sample, self.color, mode)
+            self.assertIsNotNone(grid.cost_table)
+            costs = np.abs(cost_function(colors, self.color))
+            np.testing.assert_array_equal(grid[:, :],
+                                          costs.astype(np.int64))
+
+    def test_lookup_bands_over_different_bands(self):
+        sample = tuple(LookupBand(band, np.arange(256, dtype=np.float32))
+                       for band in self.sample)
+        grid = CostGrid(sample, self.color)
+        self.assertIsNone(grid.cost_table)
+        np.testing.assert_array_equal(grid[:, :], self.costs)
+
+
+class CostGridCacheTest(unittest.TestCase):
+    """Test reusing of the cost grids of the close colors."""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.sample = tuple(rng.integers(0, 256, (300, 300))
+                            .astype(np.uint8) for _ in range(3))
+
+    def test_close_colors_share_grid(self):
+        cache = CostGridCache(self.sample)
+        grid = cache.get((10, 20, 30))
+        self.assertIs(cache.get((11, 22, 25)), grid)
+        self.assertIsNot(cache.get((10, 20, 30), 'gray_diff'), grid)
+        self.assertIsNot(cache.get((50, 20, 30)), grid)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        # the grid is built for the center of the bin
+        self.assertEqual(grid.color, (12, 20, 28))
+
+    def test_bins_are_scaled_to_range_of_type(self):
+        """Bins of 16-bit bands are as wide in their range as bins of
+        8-bit bands, the last bin is centered inside the range."""
+
+        sample = tuple(band.astype(np.uint16) * 256 for band in self.sample)
+        cache = CostGridCache(sample)
+        grid = cache.get((1000, 2000, 30000))
+        self.assertIs(cache.get((1, 2047, 29000)), grid)
+        self.assertIsNot(cache.get((1000, 2048, 30000)), grid)
+        self.assertEqual(grid.color, (1024, 1024, 29696))
+        self.assertEqual(cache.get((65535, 0, 0)).color, (64512, 1024, 1024))
+
+        signed = tuple(band.astype(np.int16) for band in self.sample)
+        self.assertEqual(CostGridCache(signed).get((-32768, 0, 32767)).color,
+                         (-31744, 1024, 31744))
+
+    def test_float_and_looked_up_colors_are_exact(self):
+        floats = tuple(band.astype(np.float32) / 255 for band in self.sample)
+        lookups = tuple(LookupBand(band, np.arange(256, dtype=np.float32))
+                        for band in self.sample)
+        for sample, color in ((floats, (0.5, 0.25, 0.75)),
+                              (lookups, (10, 20, 30))):
+            cache = CostGridCache(sample)
+            grid = cache.get(color)
+            self.assertEqual(grid.color, color)
+            self.assertIs(cache.get(color), grid)
+            self.assertIsNot(cache.get((color[0] + 1e-3,) + color[1:]),
+                             grid)
+
+    def test_least_recently_used_grid_is_dropped(self):
+        tile_bytes = TILE_SIZE * TILE_SIZE * 8
+        cache = CostGridCache(self.sample, budget=tile_bytes)
+        first = cache.get((10, 10, 10))
+        first[0:10, 0:10]
+        second = cache.get((100, 100, 100))
+        second[0:10, 0:10]
+        self.assertIs(cache.get((100, 100, 100)), second)
+        self.assertEqual(list(cache.grids.values()), [second])
+        self.assertIsNot(cache.get((10, 10, 10)), first)
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite(unittest.makeSuite(case) for case in
+                               (CostGridTest, CostGridCacheTest))
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
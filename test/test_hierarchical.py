@@ -0,0 +1,76 @@
+# coding=utf-8
+"""Tests of the routing over the tiles of the grid."""
+
+import unittest
+
+import numpy as np
+
+from raster_tracer.hierarchical import TileGraph
+
+from .test_astar import GridTestCase, dijkstra
+
+
+class TileGraphTest(GridTestCase):
+    """Test the paths routed over the entrances of the tiles."""
+
+    def test_follows_line_through_entrances(self):
+        """The entrances are the cheapest cells of the borders,
+        so the route along the line is the best path."""
+
+        graph = np.full((192, 192), 10, dtype=np.int64)
+        graph[100, 5:151] = 0
+        graph[100:186, 150] = 0
+        tile_graph = TileGraph(graph)
+        for start, goal in (((100, 5), (185, 150)),
+                            ((185, 150), (100, 5)),
+                            ((100, 5), (100, 140))):
+            path, cost = tile_graph.find_path(start, goal)
+            self.assertPath(graph, path, cost, start, goal)
+            self.assertEqual(cost, 0)
+
+    def test_start_is_entrance(self):
+        """The cell in the corner of the last tile of one pixel
+        is the entrance of both of its borders."""
+
+        graph = self.rng.integers(0, 100, (65, 65)).astype(np.int64)
+        tile_graph = TileGraph(graph)
+        for start, goal in (((64, 64), (0, 0)), ((0, 0), (64, 64)),
+                            ((63, 63), (0, 0)), ((64, 0), (0, 64))):
+            path, cost = tile_graph.find_path(start, goal)
+            self.assertPath(graph, path, cost, start, goal)
+            self.assertGreaterEqual(cost, dijkstra(graph, start)[goal])
+
+    def test_valid_paths(self):
+        for shape in ((130, 70), (129, 193)):
+            graph = self.rng.integers(0, 100, shape).astype(np.int64)
+            tile_graph = TileGraph(graph)
+            cells = [(0, 0), (shape[0] - 1, shape[1] - 1),
+                     (shape[0] // 2, 1), (shape[0] - 1, 0)]
+            for start in cells:
+                costs = dijkstra(graph, start)
+                for goal in cells:
+                    if goal == start:
+                        continue
+                    path, cost = tile_graph.find_path(start, goal)
+                    self.assertPath(graph, path, cost, start, goal)
+                    self.assertGreaterEqual(cost, costs[goal])
+
+    def test_edges_are_kept(self):
+        graph = np.ones((130, 130), dtype=np.int64)
+        tile_graph = TileGraph(graph)
+        self.assertTrue(tile_graph.prepare([(0, 0), (1, 1)]))
+        edges = tile_graph.get_edges((0, 0))
+        self.assertIs(tile_graph.get_edges((0, 0)), edges)
+        for entrance, targets in edges.items():
+            for cell, cost in targets:
+                # costs of the steps inside the uniform tile are
+                # the Manhattan distances
+                distance = abs(cell[0] - entrance[0]) + \
+                    abs(cell[1] - entrance[1])
+                self.assertEqual(cost, distance)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(TileGraphTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,86 @@
+# coding=utf-8
+"""Tests of the spatial index of the traced lines."""
+
+import unittest
+
+from qgis.core import QgsVectorLayer, QgsFeature, QgsGeometry, QgsPointXY
+
+from raster_tracer.line_index import LineIndex
+
+from .utilities import get_qgis_app
+QGIS_APP = get_qgis_app()
+
+
+def line(*points):
+    return QgsGeometry.fromPolylineXY([QgsPointXY(x, y)
+                                       for x, y in points])
+
+
+class LineIndexTest(unittest.TestCase):
+    """Test snapping through the index kept up to date with the edits."""
+
+    def setUp(self):
+        self.vlayer = QgsVectorLayer('LineString?crs=EPSG:3857',
+                                     'lines', 'memory')
+        self.vlayer.startEditing()
+        self.add_line((0, 0), (10, 0))
+        self.vlayer.commitChanges()
+        self.index = LineIndex(self.vlayer)
+
+    def tearDown(self):
+        self.index.close()
+
+    def add_line(self, *points):
+        feature = QgsFeature(self.vlayer.fields())
+        feature.setGeometry(line(*points))
+        self.vlayer.addFeature(feature)
+        return feature.id()
+
+    def test_closest_vertex(self):
+        self.assertEqual(self.index.closest_vertex(9, 1, 4), (10, 0))
+        self.assertEqual(self.index.closest_vertex(1, -1, 4), (0, 0))
+        # the segment is near, but its vertices are not
+        self.assertIsNone(self.index.closest_vertex(5, 1, 4))
+        self.assertIsNone(self.index.closest_vertex(100, 100, 4))
+
+    def test_follows_edits(self):
+        self.vlayer.startEditing()
+        fid = self.add_line((10, 5), (20, 5))
+        self.assertEqual(self.index.closest_vertex(19, 5, 4), (20, 5))
+
+        self.vlayer.changeGeometry(fid, line((10, 5), (30, 5)))
+        self.assertIsNone(self.index.closest_vertex(19, 5, 4))
+        self.assertEqual(self.index.closest_vertex(29, 5, 4), (30, 5))
+
+        self.vlayer.deleteFeature(fid)
+        self.assertIsNone(self.index.closest_vertex(29, 5, 4))
+
+        # undo of the deletion adds the line again
+        self.vlayer.undoStack().undo()
+        self.assertEqual(self.index.closest_vertex(29, 5, 4), (30, 5))
+
+        # saving the edits gives the lines new ids
+        self.vlayer.commitChanges()
+        self.assertEqual(self.index.closest_vertex(29, 5, 4), (30, 5))
+        self.assertEqual(self.index.closest_vertex(9, 1, 4), (10, 0))
+
+    def test_rollback(self):
+        self.vlayer.startEditing()
+        self.add_line((10, 5), (20, 5))
+        self.vlayer.rollBack()
+        self.assertIsNone(self.index.closest_vertex(19, 5, 4))
+        self.assertEqual(self.index.closest_vertex(9, 1, 4), (10, 0))
+
+    def test_close(self):
+        self.index.close()
+        self.vlayer.startEditing()
+        self.add_line((10, 5), (20, 5))
+        self.assertIsNone(self.index.closest_vertex(19, 5, 4))
+        self.vlayer.rollBack()
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite(unittest.makeSuite(case) for case in
+                               (LineIndexTest,))
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,100 @@
+# coding=utf-8
+"""Tests of reducing colors of the raster to the palette."""
+
+import threading
+import unittest
+
+import numpy as np
+
+from raster_tracer.cost_grid import CostGrid
+from raster_tracer.quantization import quantize, QuantizedBand
+from raster_tracer.utils import BlockCache, RasterBand, LookupBand
+
+from .utilities import FakeDataset
+
+
+def run_with_timeout(function, timeout=10):
+    """Runs the function in a thread and fails if it doesn't finish."""
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(function()),
+                              daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise AssertionError('the call did not finish, deadlock?')
+    return result[0]
+
+
+class QuantizationTest(unittest.TestCase):
+    """Test quantization of the bands read through BlockCache."""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        image = np.zeros((60, 50, 3)) + [230, 220, 200]
+        image[30:32, :] = [40, 40, 160]
+        image += rng.normal(0, 4, image.shape)
+        self.image = np.clip(image, 0, 255).astype(np.uint8)
+        self.cache = BlockCache()
+        dataset = FakeDataset([self.image[..., k] for k in range(3)],
+                              block_size=(16, 8))
+        self.bands = tuple(RasterBand(dataset, index, self.cache)
+                           for index in (1, 2, 3))
+
+    def test_quantized_band_over_raster_bands(self):
+        """Blocks of the indexes are computed from blocks of the bands
+        kept in the same cache."""
+
+        bands, error = quantize(self.bands, self.cache, 4)
+        self.assertTrue(all(isinstance(band, LookupBand) for band in bands))
+        self.assertIsInstance(bands[0].band, QuantizedBand)
+        self.assertLess(error, 20)
+
+        grid = CostGrid(bands, (40, 40, 160))
+        costs = run_with_timeout(lambda: grid[0:60, 0:50])
+        self.assertEqual(costs.shape, (60, 50))
+        # the line keeps its own color in the palette
+        self.assertLess(costs[30:32].max(), costs[:20].min())
+
+        value = run_with_timeout(lambda: bands[2][31, 10])
+        self.assertLess(abs(value - 160), 20)
+
+    def test_colors_of_16_bit_bands_keep_their_range(self):
+        """Colors of wider types are not clipped to 8 bits, so the line
+        keeps its own color and the error is not hidden."""
+
+        image = np.zeros((60, 50, 3), dtype=np.uint16) + \
+            np.array([40000, 30000, 20000], dtype=np.uint16)
+        image[30:32, :] = [1000, 1000, 60000]
+        dataset = FakeDataset([image[..., k] for k in range(3)])
+        bands = tuple(RasterBand(dataset, index, self.cache)
+                      for index in (1, 2, 3))
+
+        bands, error = quantize(bands, self.cache, 4)
+        self.assertEqual(error, 0)
+        palette = {tuple(band.table[k] for band in bands)
+                   for k in range(len(bands[0].table))}
+        self.assertEqual(palette, {(40000, 30000, 20000),
+                                   (1000, 1000, 60000)})
+
+        grid = CostGrid(bands, (1000, 1000, 60000))
+        costs = run_with_timeout(lambda: grid[0:60, 0:50])
+        self.assertEqual(costs[30:32].max(), 0)
+        self.assertGreater(costs[:20].min(), 10 ** 9)
+
+    def test_error_of_16_bit_colors(self):
+        """The error is measured on the colors as they are."""
+
+        rng = np.random.default_rng(1)
+        image = rng.integers(0, 65536, (60, 50, 3)).astype(np.uint16)
+        dataset = FakeDataset([image[..., k] for k in range(3)])
+        bands = tuple(RasterBand(dataset, index, self.cache)
+                      for index in (1, 2, 3))
+        _, error = quantize(bands, self.cache, 4)
+        self.assertGreater(error, 1000)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(QuantizationTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,121 @@
+# coding=utf-8
+"""Tests of the cache of the states prepared for the raster layers."""
+
+import unittest
+
+import numpy as np
+
+from raster_tracer.quantization import QuantizedBand
+from raster_tracer.raster_state import RasterState, RasterStateCache, \
+    get_cached_bands
+from raster_tracer.utils import BlockCache, RasterBand, LookupBand
+
+from .utilities import FakeDataset
+
+
+class RasterStateCacheTest(unittest.TestCase):
+    """Test keeping of the states and releasing of their blocks."""
+
+    def setUp(self):
+        self.blocks = BlockCache()
+        rng = np.random.default_rng(0)
+        self.arrays = [rng.integers(0, 256, (40, 40)).astype(np.uint8)
+                       for _ in range(3)]
+
+    def create_state(self):
+        """State over the bands read through the shared BlockCache,
+        with all their blocks read."""
+
+        dataset = FakeDataset(self.arrays)
+        bands = tuple(RasterBand(dataset, index, self.blocks)
+                      for index in (1, 2, 3))
+        for band in bands:
+            band[0:40, 0:40]
+        return RasterState(None, bands, None, None)
+
+    def tokens(self, state):
+        return {band.token for band in state.bands}
+
+    def cached_tokens(self):
+        return {key[0] for key in self.blocks.blocks}
+
+    def test_get_and_put(self):
+        cache = RasterStateCache()
+        state = self.create_state()
+        self.assertIsNone(cache.get('layer'))
+        cache.put('layer', state)
+        self.assertIs(cache.get('layer'), state)
+        # putting the same state again keeps its blocks
+        cache.put('layer', state)
+        self.assertEqual(self.cached_tokens(), self.tokens(state))
+
+    def test_replaced_state_is_released(self):
+        cache = RasterStateCache()
+        old_state = self.create_state()
+        new_state = self.create_state()
+        cache.put('layer', old_state)
+        cache.put('layer', new_state)
+        self.assertIs(cache.get('layer'), new_state)
+        self.assertEqual(self.cached_tokens(), self.tokens(new_state))
+
+    def test_drop(self):
+        cache = RasterStateCache()
+        state = self.create_state()
+        cache.put('layer', state)
+        cache.drop('layer')
+        cache.drop('missing')
+        self.assertIsNone(cache.get('layer'))
+        self.assertEqual(self.blocks.nbytes, 0)
+        self.assertEqual(self.blocks.blocks, {})
+
+    def test_least_recently_used_state_is_evicted(self):
+        """States are evicted by the bytes of their cost grids
+        and the blocks of the evicted states are dropped."""
+
+        # the grids of the small rasters are single tiles
+        grid_bytes = 40 * 40 * 8
+        cache = RasterStateCache(budget=grid_bytes)
+        states = [self.create_state() for _ in range(3)]
+        cache.put('first', states[0])
+        cache.put('second', states[1])
+        # using the first state makes the second one least recent
+        cache.get('first')
+        states[0].cost_grid_cache.get((0, 0, 0))[0:10, 0:10]
+        states[1].cost_grid_cache.get((0, 0, 0))[0:10, 0:10]
+        cache.put('third', states[2])
+
+        self.assertEqual(list(cache.states), ['first', 'third'])
+        self.assertEqual(cache.nbytes, grid_bytes)
+        self.assertEqual(self.cached_tokens(),
+                         self.tokens(states[0]) | self.tokens(states[2]))
+
+    def test_replaced_bands_free_only_unused_blocks(self):
+        """The bands looked up in the palette keep the blocks of the
+        band of the indexes, the quantized bands keep the blocks of
+        the sample they are built over."""
+
+        state = self.create_state()
+        index_band = state.bands[0]
+        lookup_bands = tuple(LookupBand(index_band, table) for table in
+                             np.eye(3, 256, dtype=np.float32))
+        self.assertEqual(get_cached_bands(lookup_bands), {index_band})
+
+        state.replace_bands(lookup_bands)
+        self.assertEqual(self.cached_tokens(), {index_band.token})
+        np.testing.assert_array_equal(state.bands[0][0:40, 0:40],
+                                      self.arrays[0] == 0)
+
+        quantized = QuantizedBand(lookup_bands,
+                                  np.array([[0, 0, 0]], np.float32),
+                                  self.blocks)
+        self.assertEqual(get_cached_bands((quantized,)),
+                         {quantized, index_band})
+        state.release()
+        self.assertEqual(self.blocks.blocks, {})
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite(unittest.makeSuite(case) for case in
+                               (RasterStateCacheTest,))
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
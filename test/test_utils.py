@@ -0,0 +1,313 @@
+# coding=utf-8
+"""Tests of the helpers reading rasters and building geometries."""
+
+import gc
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+from osgeo import gdal
+
+from raster_tracer.utils import BlockCache, RasterBand, widen, \
+    DiskCache, get_lookup_bands, PossiblyIndexedImageError, \
+    get_line_wkb, append_to_line_wkb, WKB_LINESTRING, WKB_MULTILINESTRING
+
+from .utilities import FakeBand, FakeColorTable, FakeDataset
+
+
+def read_line_wkb(wkb):
+    """Returns list of lines of WKB of LineString or MultiLineString
+    as arrays (n, 2) of points."""
+
+    _, wkb_type = struct.unpack_from('<BI', wkb)
+    if wkb_type == WKB_LINESTRING:
+        parts, offset = 1, 0
+    else:
+        parts, = struct.unpack_from('<I', wkb, 5)
+        offset = 9
+    lines = []
+    for _ in range(parts):
+        _, _, count = struct.unpack_from('<BII', wkb, offset)
+        lines.append(np.frombuffer(wkb, '<f8', count * 2,
+                                   offset + 9).reshape(-1, 2))
+        offset += 9 + 16 * count
+    return lines
+
+
+class BlockCacheTest(unittest.TestCase):
+    """Test reading of the bands through BlockCache."""
+
+    def test_new_band_never_gets_blocks_of_dropped_band(self):
+        """Bands created after other bands were dropped read
+        their own pixels, even if they get the same id()."""
+
+        cache = BlockCache()
+        for value in range(50):
+            array = np.full((10, 10), value, dtype=np.uint8)
+            band = RasterBand(FakeDataset([array]), 1, cache)
+            self.assertEqual(band[3, 3], value)
+            del band
+            gc.collect()
+
+    def test_drop_blocks(self):
+        """Dropped band frees its blocks in the cache."""
+
+        cache = BlockCache()
+        array = np.arange(100, dtype=np.uint8).reshape(10, 10)
+        first = RasterBand(FakeDataset([array]), 1, cache)
+        second = RasterBand(FakeDataset([array]), 1, cache)
+        first[0:10, 0:10]
+        second[0:10, 0:10]
+        nbytes = cache.nbytes
+
+        first.drop_blocks()
+        self.assertEqual(cache.nbytes, nbytes // 2)
+        self.assertTrue(all(key[0] == second.token for key in cache.blocks))
+        np.testing.assert_array_equal(first[0:10, 0:10], array)
+
+
+class WidenTest(unittest.TestCase):
+    """Test the bands kept in their own type and widened to floats."""
+
+    def test_native_type_is_kept(self):
+        for dtype in (np.uint8, np.uint16, np.float32):
+            array = np.arange(60).reshape(6, 10).astype(dtype)
+            band = RasterBand(FakeDataset([array]), 1, BlockCache())
+            self.assertEqual(band.dtype, dtype)
+            self.assertEqual(band[0:6, 0:10].dtype, dtype)
+            np.testing.assert_array_equal(band[0:6, 0:10], array)
+
+    def test_nodata_and_nan_become_zero(self):
+        array = np.array([[1, 255], [3, 4]], dtype=np.uint8)
+        band = RasterBand(FakeDataset([array], nodata=255), 1, BlockCache())
+        widened = widen(band, (slice(0, 2), slice(0, 2)))
+        self.assertEqual(widened.dtype, float)
+        np.testing.assert_array_equal(widened, [[1, 0], [3, 4]])
+        self.assertEqual(widen(band, (0, 1)), 0)
+        self.assertEqual(widen(band, (1, 1)), 4)
+
+        floats = np.array([[np.nan, 2.5]])
+        np.testing.assert_array_equal(widen(floats, (slice(0, 1),
+                                                     slice(0, 2))),
+                                      [[0, 2.5]])
+
+
+class LookupBandsTest(unittest.TestCase):
+    """Test the colors of paletted and gray rasters."""
+
+    def setUp(self):
+        self.indexes = np.array([[0, 1, 2], [3, 2, 1]], dtype=np.uint8)
+
+    def lookup_bands(self, indexes, nodata=None, color_table=None):
+        gdal_band = FakeBand(indexes, nodata=nodata,
+                             color_table=color_table)
+        band = RasterBand(FakeDataset([indexes], nodata), 1, BlockCache())
+        return get_lookup_bands(band, gdal_band)
+
+    def read(self, bands):
+        return [band[0:2, 0:3] for band in bands]
+
+    def test_palette(self):
+        """Indexes missing in the palette are black."""
+
+        entries = [(255, 0, 0, 255), (0, 255, 0, 255), (10, 20, 30, 0)]
+        bands = self.lookup_bands(
+            self.indexes,
+            color_table=FakeColorTable(entries, gdal.GPI_RGB))
+        r, g, b = self.read(bands)
+        np.testing.assert_array_equal(r, [[255, 0, 10], [0, 10, 0]])
+        np.testing.assert_array_equal(g, [[0, 255, 20], [0, 20, 255]])
+        np.testing.assert_array_equal(b, [[0, 0, 30], [0, 30, 0]])
+        self.assertTrue(all(band.band is bands[0].band for band in bands))
+
+    def test_gray_palette(self):
+        entries = [(value, 0, 0, 255) for value in (7, 8, 9, 10)]
+        bands = self.lookup_bands(
+            self.indexes,
+            color_table=FakeColorTable(entries, gdal.GPI_Gray))
+        for values in self.read(bands):
+            np.testing.assert_array_equal(values, self.indexes + 7)
+
+    def test_gray_levels_and_nodata(self):
+        for dtype, step in ((np.uint8, 50), (np.uint16, 1000)):
+            indexes = self.indexes.astype(dtype) * step
+            bands = self.lookup_bands(indexes, nodata=indexes[0, 1])
+            for values in self.read(bands):
+                expected = indexes.astype(np.float32)
+                expected[indexes == indexes[0, 1]] = np.nan
+                np.testing.assert_array_equal(values, expected)
+            widened = widen(bands[0], (slice(0, 2), slice(0, 3)))
+            self.assertEqual(widened[0, 1], 0)
+
+    def test_other_types(self):
+        """Float gray bands are traced as they are, a palette
+        over them can't be looked up."""
+
+        floats = self.indexes.astype(np.float32)
+        band, = set(self.lookup_bands(floats))
+        np.testing.assert_array_equal(band[0:2, 0:3], floats)
+        with self.assertRaises(PossiblyIndexedImageError):
+            self.lookup_bands(
+                floats,
+                color_table=FakeColorTable([(0, 0, 0, 0)], gdal.GPI_RGB))
+
+
+class DiskCacheTest(unittest.TestCase):
+    """Test the copies of the rasters kept on the disk."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_directory = os.path.join(self.directory, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_raster(self, name, arrays, data_type=gdal.GDT_Byte,
+                      nodata=None):
+        """Writes GeoTIFF with the bands and returns its path."""
+
+        path = os.path.join(self.directory, name)
+        size_i, size_j = arrays[0].shape
+        dataset = gdal.GetDriverByName('GTiff').Create(
+            path, size_j, size_i, len(arrays), data_type)
+        for index, array in enumerate(arrays, 1):
+            band = dataset.GetRasterBand(index)
+            band.WriteArray(array)
+            if nodata is not None:
+                band.SetNoDataValue(nodata)
+        dataset.FlushCache()
+        del dataset
+        return path
+
+    def entries(self):
+        return [name for name in os.listdir(self.cache_directory)
+                if not name.startswith('.')]
+
+    def test_round_trip(self):
+        """Stored bands are loaded in their own type with nodata."""
+
+        arrays = [np.arange(300, dtype=np.uint16).reshape(15, 20) * i
+                  for i in (1, 2, 3)]
+        path = self.create_raster('rgb.tif', arrays, gdal.GDT_UInt16, 7)
+        cache = DiskCache(self.cache_directory)
+        self.assertIsNone(cache.load(path, gdal.Open(path)))
+
+        self.assertTrue(cache.store(path))
+        bands = cache.load(path, gdal.Open(path))
+        self.assertEqual(len(bands), 3)
+        for band, array in zip(bands, arrays):
+            self.assertEqual(band.dtype, np.uint16)
+            self.assertEqual(band.nodata, 7)
+            np.testing.assert_array_equal(band[0:15, 0:20], array)
+            self.assertEqual(band[14, 19], array[14, 19])
+            with self.assertRaises(IndexError):
+                band[15, 0]
+
+    def test_changed_file_is_not_served(self):
+        path = self.create_raster('gray.tif', [np.zeros((8, 8), np.uint8)])
+        cache = DiskCache(self.cache_directory)
+        cache.store(path)
+        key = cache.get_key(path, gdal.Open(path))
+
+        self.create_raster('gray.tif', [np.ones((8, 8), np.uint8)])
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertNotEqual(cache.get_key(path, gdal.Open(path)), key)
+        self.assertIsNone(cache.load(path, gdal.Open(path)))
+
+    def test_mosaic_is_not_cached(self):
+        """Sources of VRT may change without changing the VRT."""
+
+        source = self.create_raster('gray.tif', [np.zeros((8, 8), np.uint8)])
+        path = os.path.join(self.directory, 'mosaic.vrt')
+        vrt = gdal.BuildVRT(path, [source])
+        vrt.FlushCache()
+        del vrt
+        cache = DiskCache(self.cache_directory)
+        self.assertIsNone(cache.get_key(path, gdal.Open(path)))
+        self.assertTrue(cache.store(path))
+        self.assertFalse(os.path.exists(self.cache_directory))
+
+    def test_budget_counts_bytes_of_data_type(self):
+        path = self.create_raster('gray.tif', [np.zeros((16, 16), np.uint16)],
+                                  gdal.GDT_UInt16)
+        dataset = gdal.Open(path)
+        self.assertIsNone(DiskCache(self.cache_directory, 511)
+                          .get_key(path, dataset))
+        self.assertIsNotNone(DiskCache(self.cache_directory, 512)
+                             .get_key(path, dataset))
+
+    def test_least_recently_used_is_evicted(self):
+        arrays = [np.full((16, 16), value, np.uint8) for value in range(3)]
+        paths = [self.create_raster('{}.tif'.format(value), [array])
+                 for value, array in enumerate(arrays)]
+        # fits two copies with the headers of .npy files
+        cache = DiskCache(self.cache_directory, 2 * (256 + 128))
+
+        cache.store(paths[0])
+        cache.store(paths[1])
+        for name in self.entries():
+            os.utime(os.path.join(self.cache_directory, name), ns=(0, 0))
+        # loading marks the first copy as used after the second one
+        cache.load(paths[0], gdal.Open(paths[0]))
+        cache.store(paths[2])
+
+        self.assertEqual(len(self.entries()), 2)
+        self.assertIsNotNone(cache.load(paths[0], gdal.Open(paths[0])))
+        self.assertIsNone(cache.load(paths[1], gdal.Open(paths[1])))
+        np.testing.assert_array_equal(
+            cache.load(paths[2], gdal.Open(paths[2]))[0][0:16, 0:16],
+            arrays[2])
+
+    def test_canceled_store_leaves_no_entry(self):
+        path = self.create_raster('gray.tif', [np.zeros((8, 8), np.uint8)])
+        cache = DiskCache(self.cache_directory)
+        self.assertFalse(cache.store(path, lambda: True))
+        self.assertEqual(os.listdir(self.cache_directory), [])
+        self.assertIsNone(cache.load(path, gdal.Open(path)))
+
+
+class LineWkbTest(unittest.TestCase):
+    """Test WKB of the traced lines."""
+
+    def test_round_trip(self):
+        points = np.array([[0.5, -1.0], [2.0, 3.25], [1e6, -1e-6]])
+        lines = read_line_wkb(get_line_wkb(points))
+        self.assertEqual(len(lines), 1)
+        np.testing.assert_array_equal(lines[0], points)
+
+    def test_append_to_line(self):
+        wkb = append_to_line_wkb(get_line_wkb([[0, 0], [1, 1]]),
+                                 [[2, 2], [3, 5]])
+        lines = read_line_wkb(wkb)
+        np.testing.assert_array_equal(lines[0],
+                                      [[0, 0], [1, 1], [2, 2], [3, 5]])
+
+    def test_append_to_last_line_of_multi_line(self):
+        first = get_line_wkb([[0, 0], [1, 0]])
+        second = get_line_wkb([[5, 5], [6, 5]])
+        wkb = struct.pack('<BII', 1, WKB_MULTILINESTRING, 2) + \
+            first + second
+        lines = read_line_wkb(append_to_line_wkb(wkb, [[7, 7]]))
+        self.assertEqual(len(lines), 2)
+        np.testing.assert_array_equal(lines[0], [[0, 0], [1, 0]])
+        np.testing.assert_array_equal(lines[1], [[5, 5], [6, 5], [7, 7]])
+
+    def test_other_types_are_not_changed(self):
+        point = struct.pack('<BIdd', 1, 1, 0.0, 0.0)
+        self.assertIsNone(append_to_line_wkb(point, [[1, 1]]))
+        line_z = struct.pack('<BII', 1, 1002, 1) + \
+            struct.pack('<ddd', 0, 0, 0)
+        self.assertIsNone(append_to_line_wkb(line_z, [[1, 1]]))
+        self.assertIsNone(append_to_line_wkb(b'', [[1, 1]]))
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite(unittest.makeSuite(case) for case in
+                               (BlockCacheTest, WidenTest, LookupBandsTest,
+                                DiskCacheTest, LineWkbTest))
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -59,3 +59,57 @@ def get_qgis_app():
         IFACE = QgisInterface(CANVAS)
 
     return QGIS_APP, CANVAS, IFACE, PARENT
+
+
+class FakeBand(object):
+    """Band of GDAL dataset over numpy array."""
+
+    def __init__(self, array, block_size=(8, 4), nodata=None,
+                 color_table=None):
+        self.array = array
+        self.YSize, self.XSize = array.shape
+        self.block_size = list(block_size)
+        self.nodata = nodata
+        self.color_table = color_table
+
+    def GetBlockSize(self):
+        return self.block_size
+
+    def GetNoDataValue(self):
+        return self.nodata
+
+    def GetColorTable(self):
+        return self.color_table
+
+    def ReadAsArray(self, x, y, width, height):
+        return self.array[y:y + height, x:x + width].copy()
+
+
+class FakeDataset(object):
+    """GDAL dataset over numpy arrays."""
+
+    def __init__(self, arrays, nodata=None, block_size=(8, 4)):
+        self.bands = [FakeBand(array, block_size, nodata)
+                      for array in arrays]
+        self.RasterYSize, self.RasterXSize = arrays[0].shape
+        self.RasterCount = len(arrays)
+
+    def GetRasterBand(self, index):
+        return self.bands[index - 1]
+
+
+class FakeColorTable(object):
+    """GDAL color table over list of entries."""
+
+    def __init__(self, entries, interpretation):
+        self.entries = entries
+        self.interpretation = interpretation
+
+    def GetPaletteInterpretation(self):
+        return self.interpretation
+
+    def GetCount(self):
+        return len(self.entries)
+
+    def GetColorEntry(self, index):
+        return self.entries[index]
@@ -1,12 +1,51 @@
+from collections import OrderedDict
+from itertools import count
+from threading import Lock
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+
 from osgeo import gdal
-from qgis.core import QgsCoordinateTransform
+from qgis.core import QgsCoordinateTransform, QgsTask, QgsGeometry
 import numpy as np
 
+# how many bytes of raster blocks BlockCache may keep
+BLOCK_CACHE_BUDGET = 256 * 1024 ** 2
+
+# keys of the bands in BlockCache, unlike id() of the bands
+# they are never reused for other bands
+BAND_TOKENS = count()
+
+# how many bytes of copies of the rasters DiskCache may keep
+DISK_CACHE_BUDGET = 8 * 1024 ** 3
+
+# data types of the indexes of the paletted and gray rasters
+# for which the colors are looked up in the tables
+LOOKUP_DTYPES = (np.uint8, np.uint16)
+
+# WKB types of 2D lines
+WKB_LINESTRING = 2
+WKB_MULTILINESTRING = 5
+
 
 class PossiblyIndexedImageError(Exception):
     pass
 
 
+def get_traced_bands(dataset):
+    '''
+    Returns indexes of the bands of the dataset that are traced:
+    the first three bands of RGB images or the only band
+    of paletted and gray images.
+    '''
+
+    if dataset.RasterCount >= 3:
+        return 1, 2, 3
+    return 1,
+
+
 def get_indxs_from_raster_coords(geo_ref, xy):
     x, y = xy
     top_left_x, top_left_y, we_resolution, ns_resolution = geo_ref
@@ -23,7 +62,482 @@ def get_coords_from_raster_indxs(geo_ref, ij):
     return x, y
 
 
-def get_whole_raster(layer, project_instance):
+def get_coords_from_raster_indxs_array(geo_ref, i, j):
+    '''
+    Same as get_coords_from_raster_indxs for arrays of indexes.
+    Returns arrays (x, y).
+    '''
+
+    top_left_x, top_left_y, we_resolution, ns_resolution = geo_ref
+    y = top_left_y - (np.asarray(i) + 0.5) * ns_resolution
+    x = top_left_x + (np.asarray(j) + 0.5) * we_resolution
+    return x, y
+
+
+def transform_coords(transform, x, y):
+    '''
+    Transforms arrays of coordinates by QgsCoordinateTransform
+    with a single call instead of a call per point. The coordinates
+    are passed to QGIS and read back as WKB without per point calls.
+    Returns arrays (x, y).
+    '''
+
+    if transform.isShortCircuited():
+        return np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+
+    geom = QgsGeometry()
+    geom.fromWkb(get_line_wkb(np.column_stack((x, y))))
+    geom.transform(transform)
+    # the transformed line is read back from its WKB after the header
+    # of the byte order, the type and the number of points
+    coords = np.frombuffer(bytes(geom.asWkb()), '<f8', offset=9)
+    coords = coords.reshape(-1, 2)
+    return coords[:, 0], coords[:, 1]
+
+
+def read_tiled(shape, tile_shape, key, get_tile, dtype):
+    '''
+    Assembles the window key = (slice, slice) of 2D grid of given shape
+    that is stored in tiles of tile_shape. get_tile(ti, tj) returns
+    the tile with the given indexes. If key is a pair of ints,
+    returns the single value and raises IndexError outside the grid.
+    '''
+
+    size_i, size_j = shape
+    tile_i, tile_j = tile_shape
+
+    if not isinstance(key[0], slice):
+        i, j = key
+        if not (0 <= i < size_i and 0 <= j < size_j):
+            raise IndexError
+        return get_tile(i // tile_i, j // tile_j)[i % tile_i, j % tile_j]
+
+    i0, i1, _ = key[0].indices(size_i)
+    j0, j1, _ = key[1].indices(size_j)
+    i1 = max(i0, i1)
+    j1 = max(j0, j1)
+
+    result = np.empty((i1 - i0, j1 - j0), dtype=dtype)
+    if result.size == 0:
+        return result
+
+    for ti in range(i0 // tile_i, (i1 - 1) // tile_i + 1):
+        tile_i0 = ti * tile_i
+        a0 = max(i0, tile_i0)
+        a1 = min(i1, tile_i0 + tile_i)
+        for tj in range(j0 // tile_j, (j1 - 1) // tile_j + 1):
+            tile_j0 = tj * tile_j
+            b0 = max(j0, tile_j0)
+            b1 = min(j1, tile_j0 + tile_j)
+            tile = get_tile(ti, tj)
+            result[a0 - i0:a1 - i0, b0 - j0:b1 - j0] = \
+                tile[a0 - tile_i0:a1 - tile_i0, b0 - tile_j0:b1 - tile_j0]
+
+    return result
+
+
+def widen(band, key):
+    '''
+    Returns band[key] as floats, with the pixels that are NaN
+    or nodata of the band set to zero. Works for windows and
+    for single pixels.
+    '''
+
+    values = np.array(band[key], dtype=float)
+    invalid = np.isnan(values)
+    nodata = getattr(band, 'nodata', None)
+    if nodata is not None:
+        invalid |= values == nodata
+    values[invalid] = 0
+    return values[()]
+
+
+class BlockCache:
+    '''
+    Least recently used cache of the blocks read from rasters.
+    The least recently used blocks are dropped while all blocks
+    take more than the budget. The lock guards only the bookkeeping,
+    blocks are read outside of it, since reading a block may read
+    blocks of other bands from the same cache, see QuantizedBand.
+    '''
+
+    def __init__(self, budget=BLOCK_CACHE_BUDGET):
+        self.budget = budget
+        self.blocks = OrderedDict()
+        self.nbytes = 0
+        self.lock = Lock()
+
+    def get(self, key, read):
+        '''
+        Returns the block by the key, calling read() if it's missing.
+        '''
+
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+                return block
+
+        block = read()
+
+        with self.lock:
+            if key in self.blocks:
+                # read by another thread meanwhile
+                return self.blocks[key]
+            self.blocks[key] = block
+            self.nbytes += block.nbytes
+            while len(self.blocks) > 1 and self.nbytes > self.budget:
+                _, dropped = self.blocks.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+            return block
+
+    def drop(self, token):
+        '''
+        Drops all blocks of the band with the given token.
+        '''
+
+        with self.lock:
+            for key in [key for key in self.blocks if key[0] == token]:
+                self.nbytes -= self.blocks.pop(key).nbytes
+
+
+class RasterBand:
+    '''
+    2D array-like band of GDAL dataset, that reads from the file only
+    the blocks of its native block size that are actually accessed.
+    Supports band[i, j] and band[i0:i1, j0:j1]. Values are kept in the
+    data type of the file, e.g. one byte per pixel for 8-bit images,
+    and NaNs and nodata are left as they are, see widen.
+    Reading is serialized by the lock, which is shared by the bands
+    of the same dataset, since GDAL datasets can't be read from
+    several threads at once.
+    '''
+
+    def __init__(self, dataset, index, cache, lock=None):
+        self.dataset = dataset
+        self.index = index
+        self.band = dataset.GetRasterBand(index)
+        self.cache = cache
+        self.token = next(BAND_TOKENS)
+        self.lock = Lock() if lock is None else lock
+        self.shape = self.band.YSize, self.band.XSize
+        block_j, block_i = self.band.GetBlockSize()
+        self.block_shape = block_i, block_j
+        self.nodata = self.band.GetNoDataValue()
+        self.dtype = self.get_block(0, 0).dtype
+
+    def read_block(self, bi, bj):
+        size_i, size_j = self.shape
+        block_i, block_j = self.block_shape
+        i0 = bi * block_i
+        j0 = bj * block_j
+        with self.lock:
+            return self.band.ReadAsArray(j0, i0,
+                                         min(block_j, size_j - j0),
+                                         min(block_i, size_i - i0))
+
+    def get_block(self, bi, bj):
+        return self.cache.get((self.token, bi, bj),
+                              lambda: self.read_block(bi, bj))
+
+    def drop_blocks(self):
+        self.cache.drop(self.token)
+
+    def __getitem__(self, key):
+        return read_tiled(self.shape, self.block_shape, key,
+                          self.get_block, self.dtype)
+
+
+class MemmapBand:
+    '''
+    2D array-like band stored in .npy file of DiskCache. The file is
+    mapped into memory, so its pages are read only when accessed
+    and are shared between QGIS instances. Supports the same
+    indexing as RasterBand.
+    '''
+
+    def __init__(self, path, nodata):
+        self.array = np.load(path, mmap_mode='r')
+        self.shape = self.array.shape
+        self.dtype = self.array.dtype
+        self.nodata = nodata
+
+    def __getitem__(self, key):
+        if not isinstance(key[0], slice):
+            i, j = key
+            size_i, size_j = self.shape
+            if not (0 <= i < size_i and 0 <= j < size_j):
+                raise IndexError
+        return np.asarray(self.array[key])
+
+
+class LookupBand:
+    '''
+    2D array-like band whose values are looked up in the table by the
+    values of another band, e.g. one color of the paletted raster.
+    Pixels that are nodata of the band are NaN.
+    '''
+
+    def __init__(self, band, table):
+        self.band = band
+        self.table = table
+        self.shape = band.shape
+        self.dtype = table.dtype
+        self.nodata = None
+
+    def __getitem__(self, key):
+        return self.table[self.band[key]]
+
+
+def get_lookup_bands(band, gdal_band):
+    '''
+    Returns tuple (r, g, b) of LookupBands with the colors of the
+    palette of the single band raster, or with the gray levels
+    if the raster has no palette. Bands of gray rasters of other
+    data types are returned as they are.
+    Raises PossiblyIndexedImageError for palettes of such types.
+    '''
+
+    color_table = gdal_band.GetColorTable()
+    if band.dtype not in LOOKUP_DTYPES:
+        if color_table is not None:
+            raise PossiblyIndexedImageError
+        return band, band, band
+
+    size = np.iinfo(band.dtype).max + 1
+    if color_table is None:
+        tables = np.tile(np.arange(size, dtype=np.float32), (3, 1))
+    else:
+        # indexes missing in the palette are black
+        tables = np.zeros((3, size), dtype=np.float32)
+        gray = color_table.GetPaletteInterpretation() == gdal.GPI_Gray
+        for index in range(min(color_table.GetCount(), size)):
+            entry = color_table.GetColorEntry(index)
+            tables[:, index] = entry[0] if gray else entry[:3]
+
+    nodata = band.nodata
+    if nodata is not None and 0 <= nodata < size and nodata == int(nodata):
+        tables[:, int(nodata)] = np.nan
+
+    return tuple(LookupBand(band, table) for table in tables)
+
+
+class DiskCache:
+    '''
+    Directory with copies of the traced bands of the rasters as .npy
+    files, that are opened as MemmapBands instead of reading the
+    rasters again. Entries are keyed by the path, modification time
+    and size of the file and by the layout of its bands, so changed
+    files are never served from the cache. Least recently used entries
+    are removed while the cache takes more than the budget.
+    '''
+
+    def __init__(self, directory, budget=DISK_CACHE_BUDGET):
+        self.directory = directory
+        self.budget = budget
+
+    def get_key(self, raster_path, dataset):
+        '''
+        Returns the name of the entry of the raster or None
+        if the raster can't be cached: it is not a plain file,
+        it is a mosaic whose sources may change without changing
+        the file or it doesn't fit the budget.
+        '''
+
+        try:
+            stat = os.stat(raster_path)
+        except OSError:
+            return None
+
+        driver = dataset.GetDriver()
+        if driver is not None and driver.ShortName == 'VRT':
+            return None
+
+        traced_bands = get_traced_bands(dataset)
+        pixels = dataset.RasterYSize * dataset.RasterXSize
+        pixel_size = sum(
+            gdal.GetDataTypeSize(dataset.GetRasterBand(index).DataType) // 8
+            for index in traced_bands)
+        if pixels * pixel_size > self.budget:
+            return None
+
+        layout = [(dataset.RasterYSize, dataset.RasterXSize)]
+        for index in traced_bands:
+            band = dataset.GetRasterBand(index)
+            layout.append((index,
+                           gdal.GetDataTypeName(band.DataType),
+                           band.GetNoDataValue()))
+        description = repr((os.path.abspath(raster_path),
+                            stat.st_mtime_ns,
+                            stat.st_size,
+                            layout))
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def band_path(self, entry, index):
+        return os.path.join(entry, '{}.npy'.format(index))
+
+    def load(self, raster_path, dataset):
+        '''
+        Returns tuple of MemmapBands of the raster
+        or None if it isn't in the cache.
+        '''
+
+        key = self.get_key(raster_path, dataset)
+        if key is None:
+            return None
+        entry = os.path.join(self.directory, key)
+
+        try:
+            bands = tuple(
+                MemmapBand(self.band_path(entry, index),
+                           dataset.GetRasterBand(index).GetNoDataValue())
+                for index in get_traced_bands(dataset))
+            # mark the entry as recently used
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        return bands
+
+    def store(self, raster_path, is_canceled=None):
+        '''
+        Copies the traced bands of the raster into the cache
+        strip by strip. Returns False if it was canceled.
+        '''
+
+        dataset = gdal.Open(raster_path)
+        if dataset is None:
+            return True
+        key = self.get_key(raster_path, dataset)
+        if key is None:
+            return True
+        entry = os.path.join(self.directory, key)
+        if os.path.isdir(entry):
+            return True
+
+        os.makedirs(self.directory, exist_ok=True)
+        # files are written aside and moved into the place at once,
+        # so other instances never see partially written entries
+        temp = tempfile.mkdtemp(dir=self.directory, prefix='.')
+        try:
+            for index in get_traced_bands(dataset):
+                if not self.store_band(dataset.GetRasterBand(index),
+                                       self.band_path(temp, index),
+                                       is_canceled):
+                    return False
+            try:
+                os.rename(temp, entry)
+            except OSError:
+                # stored by another instance meanwhile
+                pass
+        finally:
+            shutil.rmtree(temp, ignore_errors=True)
+
+        self.evict()
+        return True
+
+    def store_band(self, band, path, is_canceled=None):
+        size_i, size_j = band.YSize, band.XSize
+        _, strip = band.GetBlockSize()
+
+        array = None
+        for i0 in range(0, size_i, strip):
+            if is_canceled is not None and is_canceled():
+                return False
+            values = band.ReadAsArray(0, i0, size_j,
+                                      min(strip, size_i - i0))
+            if array is None:
+                array = np.lib.format.open_memmap(
+                    path, mode='w+', dtype=values.dtype,
+                    shape=(size_i, size_j))
+            array[i0:i0 + strip] = values
+        array.flush()
+        del array
+        return True
+
+    def evict(self):
+        '''
+        Removes least recently used entries until the cache fits
+        the budget. The most recent entry is always kept.
+        '''
+
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, file))
+                           for file in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                pass
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries[:-1]:
+            if total <= self.budget:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def get_line_wkb(points):
+    '''
+    Returns little endian WKB of LineString with the points
+    given as array-like (n, 2), packed without per point objects.
+    '''
+
+    coords = np.ascontiguousarray(points, dtype='<f8').reshape(-1, 2)
+    header = struct.pack('<BII', 1, WKB_LINESTRING, len(coords))
+    return header + coords.tobytes()
+
+
+def append_to_line_wkb(wkb, points):
+    '''
+    Returns WKB of 2D LineString or MultiLineString with the points
+    appended to its last line. Since the last line is at the end of
+    the WKB, only its number of points is changed and the coordinates
+    are added to the end. Returns None for WKB of other types.
+    '''
+
+    wkb = bytearray(wkb)
+    if len(wkb) < 9:
+        return None
+    byte_order, wkb_type = struct.unpack_from('<BI', wkb)
+    if byte_order != 1:
+        return None
+
+    if wkb_type == WKB_LINESTRING:
+        count_offset = 5
+    elif wkb_type == WKB_MULTILINESTRING:
+        parts, = struct.unpack_from('<I', wkb, 5)
+        if parts == 0:
+            return None
+        offset = 9
+        for _ in range(parts):
+            byte_order, wkb_type, count = struct.unpack_from('<BII', wkb,
+                                                             offset)
+            if byte_order != 1 or wkb_type != WKB_LINESTRING:
+                return None
+            count_offset = offset + 5
+            offset += 9 + 16 * count
+    else:
+        return None
+
+    coords = np.ascontiguousarray(points, dtype='<f8').reshape(-1, 2)
+    count, = struct.unpack_from('<I', wkb, count_offset)
+    struct.pack_into('<I', wkb, count_offset, count + len(coords))
+    return bytes(wkb) + coords.tobytes()
+
+
+def get_transforms(layer, project_instance):
+    '''
+    Returns functions (to_indexes, to_coords, to_coords_provider,
+    to_coords_provider2, to_coords_provider_array) that convert between
+    the coordinates of the project, of the raster and the indexes
+    of its pixels. The last one converts arrays of indexes at once.
+    '''
+
     provider = layer.dataProvider()
     extent = provider.extent()
 
@@ -42,23 +556,153 @@ def get_whole_raster(layer, project_instance):
 
     geo_ref = (top_left_x, top_left_y, dx, dy)
 
-    to_indexes = lambda x, y: get_indxs_from_raster_coords(
-                        geo_ref,
-                        trfm_to_src.transform(x, y))
-    to_coords = lambda i, j: trfm_from_src.transform(
-                      *get_coords_from_raster_indxs(geo_ref, (i, j)))
     to_coords_provider = lambda i, j:\
         get_coords_from_raster_indxs(geo_ref,
                                      (i, j))
-    to_coords_provider2 = lambda x, y: trfm_to_src.transform(x, y)
-    raster_path = layer.source()
+    if trfm_to_src.isShortCircuited():
+        # the raster is in the CRS of the project,
+        # so the conversions are affine and don't need PROJ
+        to_indexes = lambda x, y: get_indxs_from_raster_coords(
+                            geo_ref, (x, y))
+        to_coords = to_coords_provider
+        to_coords_provider2 = lambda x, y: (x, y)
+    else:
+        to_indexes = lambda x, y: get_indxs_from_raster_coords(
+                            geo_ref,
+                            trfm_to_src.transform(x, y))
+        to_coords = lambda i, j: trfm_from_src.transform(
+                          *get_coords_from_raster_indxs(geo_ref, (i, j)))
+        to_coords_provider2 = lambda x, y: trfm_to_src.transform(x, y)
+    to_coords_provider_array = lambda i, j:\
+        get_coords_from_raster_indxs_array(geo_ref, i, j)
+
+    return to_indexes, to_coords, to_coords_provider, to_coords_provider2, \
+        to_coords_provider_array
+
+
+def get_bands(raster_path, cache, disk_cache=None):
+    '''
+    Opens the raster and returns tuple (r, g, b) of its bands.
+    The bands are MemmapBands if they are in disk_cache, or RasterBands
+    otherwise. Colors of paletted and gray rasters are LookupBands
+    over their single band, see get_lookup_bands.
+    Raises PossiblyIndexedImageError if the raster can't be traced.
+    '''
+
     ds = gdal.Open(raster_path)
-    try:
-        band1 = np.array(ds.GetRasterBand(1).ReadAsArray())
-        band2 = np.array(ds.GetRasterBand(2).ReadAsArray())
-        band3 = np.array(ds.GetRasterBand(3).ReadAsArray())
-    except AttributeError:
+    if ds is None:
         raise PossiblyIndexedImageError
 
-    return ((band1, band2, band3), to_indexes, to_coords,
-            to_coords_provider, to_coords_provider2)
+    bands = None
+    if disk_cache is not None:
+        bands = disk_cache.load(raster_path, ds)
+    if bands is None:
+        lock = Lock()
+        bands = tuple(RasterBand(ds, index, cache, lock)
+                      for index in get_traced_bands(ds))
+
+    if len(bands) == 1:
+        return get_lookup_bands(bands[0], ds.GetRasterBand(1))
+    return bands
+
+
+class RasterLoadTask(QgsTask):
+    '''
+    Implementation of QGIS QgsTask
+    for opening of the raster on the background.
+    '''
+
+    def __init__(self, layer, transforms, cache, callback,
+                 disk_cache=None):
+        '''
+        Receives: layer - raster layer to open
+        transforms - functions returned by get_transforms for the layer,
+        they are created in the main thread since they use the project
+        cache - BlockCache for the bands
+        callback - function to call with the task and its result
+        disk_cache - DiskCache to open the bands from if possible
+        '''
+
+        super().__init__(
+            'Task for loading raster for raster_tracer',
+            QgsTask.CanCancel
+                )
+        self.layer = layer
+        self.raster_path = layer.source()
+        self.transforms = transforms
+        self.cache = cache
+        self.callback = callback
+        self.disk_cache = disk_cache
+        self.bands = None
+        self.is_unsupported = False
+        self.from_disk_cache = False
+
+    def run(self):
+        '''
+        Opens the bands and reads their first blocks.
+        '''
+
+        self.setProgress(0)
+        try:
+            bands = get_bands(self.raster_path, self.cache,
+                              self.disk_cache)
+        except PossiblyIndexedImageError:
+            self.is_unsupported = True
+            return False
+        self.setProgress(100)
+
+        if self.isCanceled():
+            return False
+        self.bands = bands
+        self.from_disk_cache = isinstance(
+            getattr(bands[0], 'band', bands[0]), MemmapBand)
+        return True
+
+    def finished(self, result):
+        '''
+        Call callback function with the result of self.run
+        '''
+
+        self.callback(self, result)
+
+    def cancel(self):
+        '''
+        Executed when run catches cancel signal.
+        Terminates the QgsTask.
+        '''
+
+        super().cancel()
+
+
+class DiskCacheTask(QgsTask):
+    '''
+    Implementation of QGIS QgsTask
+    for copying the raster into DiskCache on the background.
+    '''
+
+    def __init__(self, disk_cache, raster_path):
+        super().__init__(
+            'Task for caching raster for raster_tracer',
+            QgsTask.CanCancel
+                )
+        self.disk_cache = disk_cache
+        self.raster_path = raster_path
+
+    def run(self):
+        '''
+        Stores the raster in the cache.
+        '''
+
+        try:
+            return self.disk_cache.store(self.raster_path,
+                                         is_canceled=self.isCanceled)
+        except OSError:
+            return False
+
+    def cancel(self):
+        '''
+        Executed when run catches cancel signal.
+        Terminates the QgsTask.
+        '''
+
+        super().cancel()